@@ -1,2 +1,4 @@
-from .data_structures import Measurement, Object, Property, Catalog
-from . import choosers
\ No newline at end of file
+from .data_structures import Measurement, Object, Property, Catalog, LazyCatalog, ReferenceTable
+from . import choosers
+from .columnar import MeasurementStore, StoreCatalog
+from .instrumentation import instrument
@@ -0,0 +1,232 @@
+"""Benchmarks for deepcat. Run with
+
+    python -m deepcat.benchmark --sizes 100 1000 10000 --output results.json
+
+to time the main catalog operations on synthetic catalogs of different sizes. Results are written as JSON (a list
+of records, one per operation and size) so that runs from different versions can be compared.
+
+    python -m deepcat.benchmark --startup
+
+instead times importing deepcat and reading a small catalog in a fresh interpreter and checks that neither loads
+astropy (exiting with status 1 if one does)."""
+import argparse
+import io
+import json
+import platform
+import random
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from os.path import join as pathjoin, abspath, dirname
+from warnings import catch_warnings, simplefilter
+
+from .data_structures import Catalog, Object
+
+default_sizes = (10**2, 10**3, 10**4, 10**5, 10**6)
+
+
+def synthetic_catalog(n_objects, n_properties=5, n_measurements=3, limit_fraction=0.1, quality_fraction=0.5,
+                      error_fraction=0.8, asymmetric_fraction=0.3, n_references=200, n_custom=0, seed=0):
+    """Make a catalog of n_objects objects, each with n_properties properties that each have n_measurements
+    measurements.
+
+    limit_fraction is the fraction of measurements that are limits (split evenly between upper and lower limits,
+    but never mixing the two in one property), quality_fraction the fraction that have a quality, error_fraction
+    the fraction that have errors and asymmetric_fraction the fraction of those errors that are asymmetric.
+    References are drawn from a pool of n_references citations and each measurement gets n_custom custom
+    attributes."""
+    rng = random.Random(seed)
+    references = ['Author{} et al. ({})'.format(i, 1990 + i % 35) for i in range(n_references)]
+    property_names = ['property{}'.format(i) for i in range(n_properties)]
+    objects = []
+    for i in range(n_objects):
+        obj = Object('object{:07d}'.format(i))
+        for name in property_names:
+            limit_type = rng.choice('<>')
+            for _ in range(n_measurements):
+                value = rng.lognormvariate(0, 1)
+                error = None
+                if rng.random() < error_fraction:
+                    error = value*rng.uniform(0.01, 0.3)
+                    if rng.random() < asymmetric_fraction:
+                        error = (error, -value*rng.uniform(0.01, 0.3))
+                limit = limit_type if rng.random() < limit_fraction else '='
+                quality = rng.randint(0, 5) if rng.random() < quality_fraction else None
+                custom = {'custom{}'.format(k): rng.random() for k in range(n_custom)}
+                obj.add_measurement(name, value, error, rng.choice(references), limit, quality, **custom)
+        objects.append(obj)
+    return Catalog(objects)
+
+
+def measure(func, memory=True):
+    """Time a call to func and (optionally, in a second call) find the peak memory it allocates. Returns the
+    elapsed seconds and peak bytes (None if memory is False)."""
+    start = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - start
+
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return seconds, peak
+
+
+def _benchmarks(catalog, directory):
+    """Functions that run each benchmarked operation on a fresh state."""
+    path = pathjoin(directory, 'catalog')
+    names = catalog.object_names
+    prop = catalog.property_names[0]
+
+    def write():
+        shutil.rmtree(path, ignore_errors=True)
+        with redirect_stdout(io.StringIO()):
+            catalog.write(path)
+
+    def read():
+        Catalog.read(path)
+
+    def as_tables():
+        catalog.clear_cache()
+        with catch_warnings():
+            simplefilter('ignore')
+            catalog.as_tables()
+
+    def choose():
+        catalog.clear_cache()
+        with catch_warnings():
+            simplefilter('ignore')
+            catalog.choose(prop)
+
+    def property_names():
+        catalog._index = None
+        catalog.property_names
+
+    def add_measurements():
+        fresh = Catalog([Object(name) for name in names])
+        n = len(names)
+        fresh.add_measurements(names, 'added', [1.0]*n, [0.1]*n, ['benchmark']*n, ['=']*n, [None]*n)
+
+    return [('write', write), ('read', read), ('as_tables', as_tables), ('choose', choose),
+            ('property_names', property_names), ('add_measurements', add_measurements)]
+
+
+# run in a fresh interpreter by startup, with the catalog directory as its argument
+_startup_script = """
+import json, sys, time
+start = time.perf_counter()
+import {package}
+imported = time.perf_counter()
+astropy_on_import = any(name.split('.')[0] == 'astropy' for name in sys.modules)
+{package}.Catalog.read(sys.argv[1])
+read = time.perf_counter()
+astropy_on_read = any(name.split('.')[0] == 'astropy' for name in sys.modules)
+print(json.dumps({{'import_seconds': imported - start, 'read_seconds': read - imported,
+                  'astropy_on_import': astropy_on_import, 'astropy_on_read': astropy_on_read}}))
+"""
+
+
+def startup(n_objects=10, label=None):
+    """Time importing deepcat and reading a catalog of n_objects objects in a new Python process, as a short-lived
+    worker would, and record whether either loaded astropy (neither should). Returns a result record."""
+    package = __package__
+    directory = tempfile.mkdtemp(prefix='deepcat_benchmark_')
+    try:
+        path = pathjoin(directory, 'catalog')
+        with redirect_stdout(io.StringIO()):
+            synthetic_catalog(n_objects).write(path)
+        env = dict(os.environ)
+        parent = dirname(dirname(abspath(__file__)))
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [parent, env.get('PYTHONPATH')]))
+        out = subprocess.run([sys.executable, '-c', _startup_script.format(package=package), path], env=env,
+                             check=True, capture_output=True, text=True).stdout
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    record = {'benchmark': 'startup', 'n_objects': n_objects}
+    record.update(json.loads(out))
+    record.update({'label': label, 'python': platform.python_version()})
+    return record
+
+
+def run(sizes=default_sizes, memory=True, label=None, verbose=False, **synthetic_kws):
+    """Run every benchmark on a synthetic catalog of each size (number of objects). Extra keywords are passed to
+    synthetic_catalog. Returns a list of result records (dictionaries)."""
+    results = []
+    for n in sizes:
+        catalog = synthetic_catalog(n, **synthetic_kws)
+        n_msmts = sum(len(p) for obj in catalog.objects for p in obj.properties)
+        directory = tempfile.mkdtemp(prefix='deepcat_benchmark_')
+        try:
+            for name, func in _benchmarks(catalog, directory):
+                seconds, peak = measure(func, memory)
+                record = {'benchmark': name,
+                          'n_objects': n,
+                          'n_measurements': n_msmts,
+                          'seconds': seconds,
+                          'objects_per_second': n/seconds if seconds > 0 else None,
+                          'measurements_per_second': n_msmts/seconds if seconds > 0 else None,
+                          'peak_memory_bytes': peak,
+                          'label': label,
+                          'python': platform.python_version()}
+                results.append(record)
+                if verbose:
+                    print('{benchmark:>18} {n_objects:>9} objects {seconds:10.4f} s'.format(**record),
+                          file=sys.stderr)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Time deepcat catalog operations on synthetic catalogs.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=default_sizes, help='numbers of objects')
+    parser.add_argument('--properties', type=int, default=5, help='properties per object')
+    parser.add_argument('--measurements', type=int, default=3, help='measurements per property')
+    parser.add_argument('--limit-fraction', type=float, default=0.1)
+    parser.add_argument('--quality-fraction', type=float, default=0.5)
+    parser.add_argument('--error-fraction', type=float, default=0.8)
+    parser.add_argument('--asymmetric-fraction', type=float, default=0.3)
+    parser.add_argument('--custom', type=int, default=0, help='custom attributes per measurement')
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak memory measurements')
+    parser.add_argument('--label', default=None, help='label stored with each result, e.g. a version')
+    parser.add_argument('--output', default=None, help='file for the JSON results (default: stdout)')
+    parser.add_argument('--startup', action='store_true',
+                        help='only time import and a small read in a fresh process and check astropy stays unloaded')
+    args = parser.parse_args(args)
+
+    if args.startup:
+        record = startup(label=args.label)
+        _output([record], args.output)
+        if record['astropy_on_import'] or record['astropy_on_read']:
+            print('astropy was loaded on startup.', file=sys.stderr)
+            sys.exit(1)
+        return
+
+    results = run(args.sizes, memory=not args.no_memory, label=args.label, verbose=True,
+                  n_properties=args.properties, n_measurements=args.measurements,
+                  limit_fraction=args.limit_fraction, quality_fraction=args.quality_fraction,
+                  error_fraction=args.error_fraction, asymmetric_fraction=args.asymmetric_fraction,
+                  n_custom=args.custom)
+    _output(results, args.output)
+
+
+def _output(results, path):
+    s = json.dumps(results, indent=4)
+    if path is None:
+        print(s)
+    else:
+        with open(path, 'w') as f:
+            f.write(s)
+
+
+if __name__ == '__main__':
+    main()
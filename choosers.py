@@ -1,6 +1,8 @@
 """For consistency, function in this module should always return a list of measurements (even if narrowed down to one) or an empty list."""
 from warnings import warn
-from math import inf
+from math import inf, nan
+
+import numpy as np
 
 def default(measurements):
     if len(measurements) == 0:
@@ -71,3 +73,227 @@ def strictest_limit(measurements):
         return [m for m in measurements if m.value == min_limit]
 
     raise NotImplementedError("Can't handle a property that has upper limits and lower limits, but no actual measurements.")
+
+
+def default_batch(groups, values, limits, qualities, errors, n_groups=None):
+    """Make the same choice as default for many lists of measurements at once using array operations. Each
+    measurement is an entry in the input arrays, with groups giving the (integer) id of the list it belongs to.
+    Within a group, measurements must be in the order they would be given to default.
+
+    values, qualities and errors (the simple_error of each measurement) are float arrays with nan for None and
+    limits are coded -1, 0, 1 for <, =, >.
+
+    Returns an array with the index of the chosen measurement for each group (-1 for groups without any
+    measurements) and a boolean array that is True for the groups where default would have picked one
+    arbitrarily (and warned about it)."""
+    groups = np.asarray(groups, np.intp)
+    values = np.asarray(values, float)
+    limits = np.asarray(limits)
+    qualities = np.asarray(qualities, float)
+    errors = np.asarray(errors, float)
+    n = len(groups)
+    if n_groups is None:
+        n_groups = groups.max() + 1 if n > 0 else 0
+    chosen = np.full(n_groups, -1, np.intp)
+    arbitrary = np.zeros(n_groups, bool)
+    if n == 0:
+        return chosen, arbitrary
+
+    def count(mask):
+        # number of True entries in each entry's group, broadcast back to the entries
+        return np.bincount(groups, weights=mask, minlength=n_groups)[groups]
+
+    def extreme(ufunc, x, mask, fill):
+        # max (or min) of x over the masked entries of each group, broadcast back to the entries
+        out = np.full(n_groups, fill)
+        ufunc.at(out, groups, np.where(mask, x, fill))
+        return out[groups]
+
+    def keep_extreme(alive, ufunc, x, fill):
+        # keep the entries at the group max (or min) of x, ignoring nans, unless x is all nan for the group
+        has_x = alive & ~np.isnan(x)
+        return np.where(count(has_x) > 0, has_x & (x == extreme(ufunc, x, has_x, fill)), alive)
+
+    # nonlimits if there are any, all measurements otherwise
+    alive = limits == 0
+    no_nonlimits = count(alive) == 0
+    alive |= no_nonlimits
+
+    alive = keep_extreme(alive, np.maximum, qualities, -inf)
+
+    # strictest_limit for groups that are all limits and still undecided
+    n_alive = count(alive)
+    undecided = no_nonlimits & (n_alive > 1)
+    if np.any(undecided):
+        all_lower = count(alive & (limits == 1)) == n_alive
+        all_upper = count(alive & (limits == -1)) == n_alive
+        if np.any(undecided & ~all_lower & ~all_upper):
+            raise NotImplementedError("Can't handle a property that has upper limits and lower limits, but no "
+                                      "actual measurements.")
+        lower = alive & undecided & all_lower
+        alive = np.where(lower, values == extreme(np.maximum, values, lower, -inf), alive)
+        upper = alive & undecided & all_upper
+        alive = np.where(upper, values == extreme(np.minimum, values, upper, inf), alive)
+
+    alive = keep_extreme(alive, np.minimum, errors, inf)
+
+    # the first surviving entry of each group is the pick
+    first = np.full(n_groups, n, np.intp)
+    np.minimum.at(first, groups[alive], np.flatnonzero(alive))
+    has_pick = first < n
+    chosen[has_pick] = first[has_pick]
+    arbitrary[:] = np.bincount(groups, weights=alive, minlength=n_groups) > 1
+    return chosen, arbitrary
+
+
+def _number(x):
+    # numbers as floats, anything else (None, strings, ...) as nan
+    if isinstance(x, (int, float, np.integer, np.floating)) and not isinstance(x, (bool, np.bool_)):
+        return float(x)
+    return nan
+
+
+class _PreferNonlimit(object):
+    def key(self, measurement):
+        return 0. if measurement.limit == '=' else 1.
+
+    def array(self, column):
+        return (column('limit') != 0).astype(float)
+
+    def __repr__(self):
+        return 'prefer_nonlimit'
+
+
+class _PreferStrictestLimit(object):
+    def key(self, measurement):
+        if measurement.limit == '>':
+            return -_number(measurement.value)
+        if measurement.limit == '<':
+            return _number(measurement.value)
+        return 0.
+
+    def array(self, column):
+        limits, values = column('limit'), column('value')
+        return np.where(limits == 1, -values, np.where(limits == -1, values, 0.))
+
+    def __repr__(self):
+        return 'prefer_strictest_limit'
+
+
+class _Extreme(object):
+    def __init__(self, attribute, sign):
+        self.spec = attribute
+        self.attribute = attribute[len('custom:'):] if attribute.startswith('custom:') else attribute
+        self.sign = sign
+
+    def key(self, measurement):
+        return self.sign*_number(getattr(measurement, self.attribute, None))
+
+    def array(self, column):
+        return self.sign*column(self.attribute)
+
+    def __repr__(self):
+        return "{}('{}')".format('maximize' if self.sign < 0 else 'minimize', self.spec)
+
+
+# measurements that aren't limits first
+prefer_nonlimit = _PreferNonlimit()
+
+# the highest lower limit or lowest upper limit first (nonlimits are all the same to this step)
+prefer_strictest_limit = _PreferStrictestLimit()
+
+
+def maximize(attribute):
+    """Step that puts the measurements with the largest value of attribute (e.g. 'quality', or 'custom:epoch'
+    for a custom attribute) first. Measurements without a numeric value for it go last."""
+    return _Extreme(attribute, -1.)
+
+
+def minimize(attribute):
+    """Like maximize, but smallest first (e.g. minimize('simple_error') for the most precise)."""
+    return _Extreme(attribute, 1.)
+
+
+class Pipeline(object):
+    """A chooser built from a list of steps, like
+
+        Pipeline([prefer_nonlimit, maximize('quality'), minimize('simple_error'), minimize('custom:epoch')])
+
+    that ranks measurements by the first step, breaks ties with the second, and so on, and picks the best ranked
+    (the earliest in the list if some are tied in every step). Each measurement is ranked once with a tuple of
+    keys, rather than by filtering the list again for each step. A catalog's chooser can be set to a Pipeline
+    or just the list of steps.
+
+    Unlike the other choosers, ties are reported as data (see choose and batch) instead of with warnings.
+
+    Pipeline([prefer_nonlimit, maximize('quality'), prefer_strictest_limit, minimize('simple_error')]) picks
+    the same measurement as default, except that default raises an error for a mix of upper and lower limits
+    with no nonlimits, while this puts lower limits first."""
+
+    def __init__(self, steps):
+        self.steps = list(steps)
+
+    def key(self, measurement):
+        """The tuple that measurements are sorted by (smaller is better), with inf for missing values."""
+        keys = (step.key(measurement) for step in self.steps)
+        return tuple(inf if k != k else k for k in keys)
+
+    def choose(self, measurements):
+        """Return the chosen measurement (None if there are none) and a list of the other measurements that
+        were tied with it in every step."""
+        if len(measurements) == 0:
+            return None, []
+        keys = [self.key(m) for m in measurements]
+        best = min(range(len(keys)), key=keys.__getitem__)
+        tied = [m for i, (m, k) in enumerate(zip(measurements, keys)) if k == keys[best] and i != best]
+        return measurements[best], tied
+
+    def __call__(self, measurements):
+        chosen, tied = self.choose(measurements)
+        return [] if chosen is None else chosen
+
+    def batch(self, groups, column, n_groups=None):
+        """Choose for many lists of measurements at once with a single lexsort. groups gives the (integer) id of
+        the list each measurement belongs to, in the order the lists would be given to choose, and column is a
+        function that returns a float array (nan for missing) of an attribute of every measurement given its
+        name ('value', 'quality', 'simple_error', a custom attribute, ...) or, for 'limit', the codes -1, 0, 1
+        for <, =, >.
+
+        Returns an array with the index of the chosen measurement for each group (-1 for groups without any)
+        and an array of the number of other measurements tied with it."""
+        groups = np.asarray(groups, np.intp)
+        n = len(groups)
+        if n_groups is None:
+            n_groups = groups.max() + 1 if n > 0 else 0
+        chosen = np.full(n_groups, -1, np.intp)
+        n_tied = np.zeros(n_groups, np.intp)
+        if n == 0:
+            return chosen, n_tied
+
+        keys = [np.asarray(step.array(column), float) for step in self.steps]
+        keys = [np.where(np.isnan(k), inf, k) for k in keys]
+        # lexsort is stable and sorts by the last key first
+        order = np.lexsort(keys[::-1] + [groups])
+        sorted_groups = groups[order]
+        new_group = np.r_[True, sorted_groups[1:] != sorted_groups[:-1]]
+        starts = np.flatnonzero(new_group)
+        chosen[sorted_groups[starts]] = order[starts]
+
+        # entries (in sorted order) that have the same keys as the first entry of their group
+        first = order[starts][np.cumsum(new_group) - 1]
+        same = np.ones(n, bool)
+        for k in keys:
+            same &= k[order] == k[first]
+        counts = np.bincount(sorted_groups, weights=same, minlength=n_groups).astype(np.intp)
+        n_tied[:] = np.maximum(counts - 1, 0)
+        return chosen, n_tied
+
+    def tie_warnings(self, tied):
+        # what would have been caught from a chooser that warns about ties, for the code that expects that
+        if len(tied) == 0:
+            return []
+        return [UserWarning('{} measurement(s) tied with the one picked in every step of the chooser. Picking '
+                            'the first one.'.format(len(tied)))]
+
+    def __repr__(self):
+        return 'Pipeline({})'.format(self.steps)
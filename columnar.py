@@ -0,0 +1,528 @@
+"""Columnar storage for the measurements of a catalog. A MeasurementStore keeps every measurement in a handful of
+contiguous numpy arrays (one entry per measurement) instead of one Python object per measurement, which is much
+more compact for large catalogs and lets whole-catalog operations (like choosing a measurement for every object)
+be done with array operations.
+
+A StoreCatalog is a catalog backed by a store: its Objects, Properties and Measurements are only built from the
+columns when they are used, and only a bounded number of them are kept in memory, so the usual API works on top
+of the columns without holding millions of Python objects. Changes go in the built objects and are saved when the
+catalog is written, while the store itself isn't changed. Catalog.to_store, on the other hand, makes a detached
+copy of a catalog's measurements.
+
+Anything that doesn't fit in the columns (custom attributes of measurements or properties) goes in overflow
+dictionaries keyed by row (or slot) number. Numpy arrays among them are kept as they are, and arrays that are still
+in .npy files of a catalog directory aren't read until they are used.
+
+A store can be saved to a single "packed" file (MeasurementStore.save, Catalog.write_packed) that holds a JSON
+header with the string tables and custom attributes followed by the raw numeric columns and any array-valued
+custom attributes. The columns and arrays can be memory-mapped when the file is loaded again, so they can be used
+without reading the whole file, e.g. by Catalog.read_packed(path, mmap=True, lazy=True)."""
+import json
+from collections import OrderedDict
+from itertools import islice
+from os import replace, remove, getpid
+from os.path import exists
+
+import numpy as np
+
+from .data_structures import (Catalog, LazyCatalog, Object, Property, Measurement, ReferenceTable, _ArrayFile,
+                              _LazyObjects, _array_key, _stash_arrays, _warn_arbitrary)
+from . import choosers
+
+limit_codes = {'<': -1, '=': 0, '>': 1}
+limit_flags = {-1: '<', 0: '=', 1: '>'}
+
+# the largest integer a float64 holds exactly
+_max_exact_int = 2**53
+
+_packed_magic = b'DEEPCAT\x01'
+_packed_alignment = 64
+
+
+def _kind(values):
+    """Figure out how a column of Python values can be stored: 'float' and 'int' columns are kept as float64
+    arrays (with nan for None), anything else (strings, a mix of ints and floats, etc.) in an object array."""
+    kinds = set()
+    for v in values:
+        if v is None:
+            continue
+        if isinstance(v, (bool, np.bool_)):
+            return 'object'
+        elif isinstance(v, (float, np.floating)):
+            kinds.add('float')
+        elif isinstance(v, (int, np.integer)) and abs(v) <= _max_exact_int:
+            kinds.add('int')
+        else:
+            return 'object'
+        if len(kinds) > 1:
+            return 'object'
+    return kinds.pop() if kinds else 'float'
+
+
+def pack_column(values, kind=None):
+    if kind is None:
+        kind = _kind(values)
+    if kind == 'object':
+        col = np.empty(len(values), object)
+        col[:] = values
+    else:
+        col = np.array([np.nan if v is None else v for v in values], float)
+    return col, kind
+
+
+def as_float(col):
+    """Float version of a (possibly object) column, with nan for None."""
+    if col.dtype == object:
+        return np.array([np.nan if v is None else v for v in col], float)
+    return col.astype(float, copy=False)
+
+
+def unpack_value(x, kind):
+    if kind == 'object':
+        return x
+    if x != x:
+        return None
+    if kind == 'int':
+        return int(x)
+    return float(x)
+
+
+class MeasurementStore(object):
+    """Struct-of-arrays version of the measurements of a catalog (see the module docstring).
+
+    Every Property instance in the catalog gets a "slot", with slot_object and slot_name giving the object and
+    property name ids of each slot. Every measurement is a row in the value, errpos, errneg, limit, quality, and
+    reference columns, with slot, object and property giving its owner. Rows are ordered by slot and slots by
+    object, in the order of the catalog. Limits are stored as codes (see limit_codes) and references as ids into
+    the references list (-1 for None). If the catalog had a ReferenceTable, its ids are the ones used and
+    reference_metadata holds its metadata (it is None otherwise)."""
+
+    columns = ('value', 'errpos', 'errneg', 'limit', 'quality', 'reference', 'slot', 'object', 'property')
+    float_columns = ('value', 'errpos', 'errneg', 'quality')
+
+    def __init__(self, objects, names, references, slot_object, slot_name, columns, kinds=None,
+                 attributes=None, slot_attributes=None, reference_metadata=None):
+        self.objects = list(objects)
+        self.names = list(names)
+        self.references = list(references)
+        self.reference_metadata = reference_metadata
+        self.slot_object = np.asarray(slot_object, np.int32)
+        self.slot_name = np.asarray(slot_name, np.int32)
+        for key in self.columns:
+            setattr(self, key, columns[key])
+        self.kinds = {key: 'float' for key in self.float_columns}
+        if kinds is not None:
+            self.kinds.update(kinds)
+        self.attributes = {} if attributes is None else attributes
+        self.slot_attributes = {} if slot_attributes is None else slot_attributes
+        self._object_ids = {name: i for i, name in enumerate(self.objects)}
+        self._name_ids = {name: i for i, name in enumerate(self.names)}
+        self._bounds = None
+
+    @classmethod
+    def from_catalog(cls, catalog):
+        """Make a store of the measurements of catalog. Objects are taken one at a time, so a LazyCatalog never
+        has more than its cache of objects in memory while this goes through it."""
+        names, name_ids = [], {}
+        references, reference_ids = [], {}
+        reference_metadata = None
+        table = catalog._references
+        if table is not None:
+            references, reference_ids = list(table.citations), dict(table._ids)
+            reference_metadata = {i: table.metadata(c) for i, c in enumerate(references) if i in table._metadata}
+        slot_object, slot_name, slot_attributes = [], [], {}
+        values, errpos, errneg, limits, qualities, refs, slots = [], [], [], [], [], [], []
+        attributes = {}
+        object_names = catalog.object_names
+        for oid, oname in enumerate(object_names):
+            for prop in catalog[oname].properties:
+                slot = len(slot_object)
+                if prop.name not in name_ids:
+                    name_ids[prop.name] = len(names)
+                    names.append(prop.name)
+                slot_object.append(oid)
+                slot_name.append(name_ids[prop.name])
+                # in the order the property has them (custom_attributes is a set)
+                pattrs = {k: v for k, v in prop._state().items() if k not in ('name', 'measurements')}
+                if pattrs:
+                    slot_attributes[slot] = pattrs
+
+                for m in prop.measurements:
+                    # straight from _custom, so arrays that haven't been loaded from their files aren't
+                    if m._custom:
+                        attributes[len(values)] = dict(m._custom)
+                    values.append(m.value)
+                    errpos.append(m.errpos)
+                    errneg.append(m.errneg)
+                    limits.append(limit_codes[m.limit])
+                    qualities.append(m.quality)
+                    ref = m.reference
+                    if ref is None:
+                        refs.append(-1)
+                    else:
+                        if ref not in reference_ids:
+                            reference_ids[ref] = len(references)
+                            references.append(ref)
+                        refs.append(reference_ids[ref])
+                    slots.append(slot)
+
+        columns, kinds = {}, {}
+        for key, vals in zip(cls.float_columns, (values, errpos, errneg, qualities)):
+            columns[key], kinds[key] = pack_column(vals)
+        columns['limit'] = np.array(limits, np.int8)
+        columns['reference'] = np.array(refs, np.int32)
+        columns['slot'] = slot = np.array(slots, np.int32)
+        slot_object = np.array(slot_object, np.int32)
+        slot_name = np.array(slot_name, np.int32)
+        columns['object'] = slot_object[slot]
+        columns['property'] = slot_name[slot]
+        return cls(object_names, names, references, slot_object, slot_name, columns, kinds, attributes,
+                   slot_attributes, reference_metadata)
+
+    def __len__(self):
+        return len(self.value)
+
+    def __contains__(self, item):
+        return item in self._object_ids
+
+    @property
+    def n_slots(self):
+        return len(self.slot_object)
+
+    def rows(self, property=None, object=None):
+        """Indices of the rows (measurements) belonging to a property name and/or an object name."""
+        keep = np.ones(len(self), bool)
+        if property is not None:
+            if property not in self._name_ids:
+                return np.zeros(0, int)
+            keep &= self.property == self._name_ids[property]
+        if object is not None:
+            oid = self._object_ids[object]
+            start, stop = np.searchsorted(self.object, [oid, oid + 1])
+            keep[:start] = False
+            keep[stop:] = False
+        return np.nonzero(keep)[0]
+
+    def simple_error(self, rows=slice(None)):
+        """Same as Measurement.simple_error for the given rows, with nan where there is no error."""
+        errpos = as_float(self.errpos[rows])
+        errneg = as_float(self.errneg[rows])
+        return (np.abs(errpos) + np.abs(errneg))/2.
+
+    def choose(self, property, chooser=None):
+        """Pick a measurement of property for every object in the store the way choosers.default would, using
+        choosers.default_batch, or with a choosers.Pipeline (or list of its steps) as chooser. Returns the chosen
+        row for each object (-1 where the object has no measurements of the property) and a mask of the objects
+        for which the pick was arbitrary (tied, for a Pipeline)."""
+        rows = self.rows(property=property)
+        if chooser is None:
+            # values that aren't numbers (like spectral types) are nan, which only matters for limits
+            chosen, arbitrary = choosers.default_batch(self.object[rows], self._numbers('value', rows),
+                                                       self.limit[rows], self._numbers('quality', rows),
+                                                       self.simple_error(rows), n_groups=len(self.objects))
+        else:
+            if type(chooser) in (list, tuple):
+                chooser = choosers.Pipeline(chooser)
+            chosen, n_tied = chooser.batch(self.object[rows], lambda name: self._numbers(name, rows),
+                                           n_groups=len(self.objects))
+            arbitrary = n_tied > 0
+        chosen = np.where(chosen >= 0, rows[np.maximum(chosen, 0)] if len(rows) else -1, -1)
+        return chosen, arbitrary
+
+    def _numbers(self, name, rows):
+        # a column (or custom attribute) for the given rows as floats, with nan for anything that isn't a number
+        if name == 'limit':
+            return self.limit[rows].astype(float)
+        if name == 'simple_error':
+            return self.simple_error(rows)
+        if name in self.float_columns:
+            col = getattr(self, name)[rows]
+            if self.kinds[name] != 'object':
+                return col.astype(float)
+        else:
+            col = [self.attributes.get(int(row), {}).get(name) for row in rows]
+        return np.array([choosers._number(v) for v in col], float)
+
+    def reference_of(self, row):
+        i = self.reference[row]
+        return None if i < 0 else self.references[i]
+
+    def measurement(self, row):
+        """Build the Measurement stored in a row."""
+        return self.measurements([row])[0]
+
+    def measurements(self, rows):
+        """Build the Measurements stored in rows (much quicker than measurement for many rows)."""
+        rows = np.asarray(rows, int)
+        kinds = self.kinds
+        values, errpos, errneg, qualities = [[unpack_value(x, kinds[key]) for x in getattr(self, key)[rows].tolist()]
+                                             for key in ('value', 'errpos', 'errneg', 'quality')]
+        new, references, attributes = Measurement._trusted, self.references, self.attributes
+        msmts = []
+        for row, value, pos, neg, limit, quality, ref in zip(rows.tolist(), values, errpos, errneg,
+                                                              self.limit[rows].tolist(), qualities,
+                                                              self.reference[rows].tolist()):
+            custom = attributes.get(row)
+            msmts.append(new(value, None if pos is None else (pos, neg), None if ref < 0 else references[ref],
+                             limit_flags[limit], quality, None if custom is None else dict(custom)))
+        return msmts
+
+    def _slot_bounds(self):
+        # rows are ordered by slot and slots by object, so each slot's measurements and each object's slots are a
+        # contiguous run. Worked out once, since the store isn't changed after it is made
+        if self._bounds is None:
+            self._bounds = (np.searchsorted(self.slot, np.arange(self.n_slots + 1)),
+                            np.searchsorted(self.slot_object, np.arange(len(self.objects) + 1)))
+        return self._bounds
+
+    def _build_objects(self, oids, keep=None):
+        # keep, if given, is a boolean array over slots of the properties to build
+        bounds, slot_bounds = self._slot_bounds()
+        slots = [slot for oid in oids for slot in range(slot_bounds[oid], slot_bounds[oid + 1])
+                 if keep is None or keep[slot]]
+        # the measurements of all the slots are built in one go, which is much quicker than slot by slot
+        starts, stops = bounds[slots].tolist(), bounds[np.add(slots, 1)].tolist()
+        rows = np.concatenate([np.arange(0)] + [np.arange(start, stop) for start, stop in zip(starts, stops)])
+        msmts = iter(self.measurements(rows))
+        props = {}
+        for slot, start, stop in zip(slots, starts, stops):
+            # attributes passed to the constructor, so they keep the order they have in a property read from its file
+            props.setdefault(int(self.slot_object[slot]), []).append(
+                Property(self.names[self.slot_name[slot]], list(islice(msmts, stop - start)),
+                         **self.slot_attributes.get(slot, {})))
+        return [Object(self.objects[oid], props.get(oid, [])) for oid in oids]
+
+    def build_object(self, name):
+        """Build the Object with the given name from the store."""
+        return self._build_objects([self._object_ids[name]])[0]
+
+    def to_catalog(self, chooser='default', properties=None):
+        """Build a Catalog from the store. If properties is a list of property names, only those properties are
+        built and objects that have none of them are left out."""
+        if properties is None:
+            objects = self._build_objects(range(len(self.objects)))
+        else:
+            ids = [i for i, name in enumerate(self.names) if name in set(properties)]
+            keep = np.isin(self.slot_name, ids)
+            oids = np.unique(self.slot_object[keep])
+            objects = self._build_objects(oids, keep)
+        catalog = Catalog(objects, chooser)
+        if self.reference_metadata is not None:
+            catalog._references = ReferenceTable(self.references, self.reference_metadata)
+        return catalog
+
+    def save(self, path):
+        """Write the store to a single packed file (see the module docstring). The file is written to a
+        temporary file first and then renamed into place."""
+        arrays = {key: getattr(self, key) for key in self.columns}
+        arrays['slot_object'] = self.slot_object
+        arrays['slot_name'] = self.slot_name
+        object_columns = {}
+        for key, kind in self.kinds.items():
+            if kind == 'object':
+                object_columns[key] = arrays.pop(key).tolist()
+
+        # array-valued custom attributes are packed after the columns, referred to the same way as the .npy
+        # files of a catalog directory
+        attribute_arrays = {}
+        attributes = _stash_all(self.attributes, attribute_arrays)
+        slot_attributes = _stash_all(self.slot_attributes, attribute_arrays)
+        for key, arr in attribute_arrays.items():
+            arrays[key] = arr.load() if isinstance(arr, _ArrayFile) else arr
+
+        header = {'objects': self.objects,
+                  'names': self.names,
+                  'references': self.references,
+                  'reference_metadata': None if self.reference_metadata is None else
+                      {str(k): v for k, v in self.reference_metadata.items()},
+                  'kinds': self.kinds,
+                  'object_columns': object_columns,
+                  'attributes': attributes,
+                  'slot_attributes': slot_attributes,
+                  'attribute_arrays': sorted(attribute_arrays),
+                  'arrays': {}}
+
+        # lay out the arrays after the header, each starting on an aligned offset so they can be memory-mapped
+        offsets = {}
+        size = 0
+        for key, arr in arrays.items():
+            arr = np.ascontiguousarray(arr)
+            arrays[key] = arr
+            offsets[key] = size
+            header['arrays'][key] = {'dtype': arr.dtype.str, 'shape': list(arr.shape), 'offset': size}
+            size += _aligned(arr.nbytes)
+        header = json.dumps(header).encode()
+        start = _aligned(len(_packed_magic) + 8 + len(header))
+
+        tmp_path = '{}.{}.tmp'.format(path, getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(_packed_magic)
+                f.write(np.uint64(len(header)).tobytes())
+                f.write(header)
+                for key, arr in arrays.items():
+                    f.seek(start + offsets[key])
+                    f.write(arr.tobytes())
+                f.truncate(start + size)
+            replace(tmp_path, path)
+        except BaseException:
+            if exists(tmp_path):
+                remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path, mmap=False):
+        """Load a store from a packed file. With mmap=True, the numeric columns are read-only memory maps of the
+        file rather than arrays in memory."""
+        with open(path, 'rb') as f:
+            if f.read(len(_packed_magic)) != _packed_magic:
+                raise ValueError('{} is not a packed deepcat file.'.format(path))
+            n = int(np.frombuffer(f.read(8), np.uint64)[0])
+            header = json.loads(f.read(n).decode())
+        start = _aligned(len(_packed_magic) + 8 + n)
+
+        arrays = {}
+        for key, info in header['arrays'].items():
+            dtype, shape = np.dtype(info['dtype']), tuple(info['shape'])
+            offset = start + info['offset']
+            if mmap and np.prod(shape) > 0:
+                arrays[key] = np.memmap(path, dtype, mode='r', offset=offset, shape=shape)
+            else:
+                arrays[key] = np.fromfile(path, dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+        for key, values in header['object_columns'].items():
+            arrays[key], _ = pack_column(values, 'object')
+
+        attribute_arrays = {key: arrays.pop(key) for key in header.get('attribute_arrays', [])}
+        attributes = _unstash_all(header['attributes'], attribute_arrays)
+        slot_attributes = _unstash_all(header['slot_attributes'], attribute_arrays)
+        reference_metadata = header.get('reference_metadata')
+        if reference_metadata is not None:
+            reference_metadata = {int(k): v for k, v in reference_metadata.items()}
+        return cls(header['objects'], header['names'], header['references'], arrays.pop('slot_object'),
+                   arrays.pop('slot_name'), arrays, header['kinds'], attributes, slot_attributes, reference_metadata)
+
+
+class StoreCatalog(LazyCatalog):
+    """A catalog kept in the columns of a MeasurementStore, whose Objects (with their Properties and Measurements)
+    are only built from the columns when they are used. As with LazyCatalog, which this works like, up to
+    cache_size built objects are kept in memory, objects that are changed (or added) are kept until the catalog
+    is written, and anything that needs every object builds them all in turn. Listing object and property names
+    and choosing measurements with the default chooser (choose with object='all') work from the columns without
+    building objects.
+
+    The store isn't changed: changes are kept in the built objects. After the catalog is written to a directory
+    it is tied to that directory like a LazyCatalog read from it, and objects are read from their files from
+    then on. If properties is a list of property names, only those properties are built and objects that have
+    none of them are left out."""
+
+    def __init__(self, store, cache_size=1024, chooser='default', properties=None):
+        super(LazyCatalog, self).__init__(None, chooser)
+        self.store = store
+        self._keep = None
+        oids = range(len(store.objects))
+        if properties is not None:
+            ids = [i for i, name in enumerate(store.names) if name in set(properties)]
+            self._keep = np.isin(store.slot_name, ids)
+            oids = np.unique(store.slot_object[self._keep]).tolist()
+        # objects are found in the store by their id
+        paths = OrderedDict((store.objects[oid], oid) for oid in oids)
+        self._objects = _LazyObjects(self, paths, cache_size, properties)
+        self._store_choices = {}
+        if store.reference_metadata is not None:
+            self._references = ReferenceTable(store.references, store.reference_metadata)
+
+    def _load_object(self, name, source, properties=None):
+        if type(source) is int:
+            return self.store._build_objects([source], self._keep)[0]
+        return super(StoreCatalog, self)._load_object(name, source, properties)
+
+    def _in_store(self, name):
+        # whether the object is still just as it is in the store
+        source = self._objects.paths[name]
+        if type(source) is not int or name in self._pending:
+            return False
+        obj = self._objects.get(name)
+        return obj is None or self._is_clean(obj)
+
+    def _property_index(self):
+        if self._index is None:
+            store = self.store
+            in_store = np.zeros(len(store.objects), bool)
+            others = []
+            for name, source in self._objects.paths.items():
+                if type(source) is int and self._objects.get(name) is None:
+                    in_store[source] = True
+                else:
+                    others.append(name)
+            slots = np.arange(store.n_slots) if self._keep is None else np.flatnonzero(self._keep)
+            slots = slots[in_store[store.slot_object[slots]]]
+            index = {}
+            for i, pname in enumerate(store.names):
+                oids = store.slot_object[slots[store.slot_name[slots] == i]]
+                if len(oids) > 0:
+                    index[pname] = {store.objects[oid] for oid in oids.tolist()}
+            for name in others:
+                for pname in self._objects[name].property_names:
+                    index.setdefault(pname, set()).add(name)
+            self._index = index
+        return self._index
+
+    def choose(self, property, object='all', quantity='value', default=None, workers=None, pool='process'):
+        """See Catalog.choose. With the default chooser and object='all', measurements of the objects that are
+        still as they are in the store are picked from its columns (see MeasurementStore.choose)."""
+        if object != 'all' or self.chooser is not choosers.default:
+            return super(StoreCatalog, self).choose(property, object, quantity, default, workers, pool)
+        if property not in self._store_choices:
+            if self._keep is not None and property not in self._objects.properties:
+                n = len(self.store.objects)
+                self._store_choices[property] = np.full(n, -1), np.zeros(n, bool)
+            else:
+                self._store_choices[property] = self.store.choose(property)
+        rows, arbitrary = self._store_choices[property]
+
+        values, arbitrary_picks, from_store = [], [], []
+        for i, name in enumerate(self.object_names):
+            if not self._in_store(name):
+                values.append(super(StoreCatalog, self).choose(property, name, quantity, default))
+                continue
+            oid = self._objects.paths[name]
+            values.append(default)
+            if rows[oid] >= 0:
+                from_store.append((i, rows[oid]))
+                if arbitrary[oid]:
+                    arbitrary_picks.append((i, 0, name, property))
+        if from_store:
+            index, chosen = zip(*from_store)
+            for i, msmt in zip(index, self.store.measurements(chosen)):
+                values[i] = getattr(msmt, quantity)
+        _warn_arbitrary(arbitrary_picks)
+        return values
+
+    def to_store(self):
+        """The store itself if the catalog has all of it and nothing has changed, otherwise a new store (see
+        Catalog.to_store)."""
+        if self._keep is None and self._synced_path is None and not self.modified:
+            return self.store
+        return super(StoreCatalog, self).to_store()
+
+
+def _aligned(n):
+    return -(-n // _packed_alignment) * _packed_alignment
+
+
+def _stash_all(attributes, arrays):
+    # the overflow attributes in json form, with their arrays swapped for references and put in arrays
+    stashed = {}
+    for k, d in attributes.items():
+        d = dict(d)
+        _stash_arrays(d, arrays)
+        stashed[str(k)] = d
+    return stashed
+
+
+def _unstash_all(attributes, arrays):
+    for d in attributes.values():
+        for key, value in d.items():
+            if type(value) is dict and len(value) == 1 and _array_key in value:
+                d[key] = arrays[value[_array_key]]
+    return {int(k): d for k, d in attributes.items()}
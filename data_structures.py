@@ -1,17 +1,51 @@
 import json
+import gc
+import hashlib
+import pickle
+import shutil
+from difflib import SequenceMatcher
+import sys
+import threading
+from bisect import bisect_left, bisect_right
+from weakref import ref as weakref, WeakValueDictionary
+from collections import deque, OrderedDict
+from contextlib import contextmanager, nullcontext
+from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from genericpath import exists
-from glob import glob
-from os import remove, mkdir
-from os.path import join as pathjoin
-from astropy.table import Table, MaskedColumn
+from glob import glob, escape as glob_escape
+from os import remove, mkdir, makedirs, replace, getpid, stat, rmdir, listdir, fsync
+from os.path import join as pathjoin, basename, abspath, dirname, relpath
 from math import nan
 import warnings
+from urllib.parse import unquote
+
+import numpy as np
 
 from . import choosers
+from . import instrumentation
 
 warn = warnings.warn
 
+_cache_dir = '.deepcat_cache'
+_cache_version = 2
+
+_journal_file = 'journal.jsonl'
+_references_file = 'references.json'
+# array-valued custom attributes of measurements are saved in .npy files in this directory (named by a hash of
+# their content) and appear in the json as {_array_key: path relative to the catalog directory}
+_arrays_dir = 'arrays'
+_array_key = '__npy__'
+_layout_file = 'layout.json'
+_layouts = ('flat', 'sharded')
+# number of hex digits of the hash of an object's name used to name its subdirectory in the sharded layout
+_prefix_length = 2
+# characters that can't safely go in a filename on some system, plus % since it is used to escape the others
+_unsafe_characters = set('/\\%:*?"<>|') | set(map(chr, range(32))) | {chr(127)}
+
 def make_column(name, values, dtype='guess'):
+    # astropy is slow to import, so it is only brought in when tables are actually made
+    from astropy.table import MaskedColumn
     good = list(filter(None, values))
 
     if dtype == 'guess':
@@ -35,14 +69,345 @@ def make_column(name, values, dtype='guess'):
     return MaskedColumn(values, name=name, mask=mask, dtype=dtype)
 
 
-class Extensible(object):
+# attribute of Measurement holding each quantity of Catalog.to_arrays and the fill value and dtype of its arrays
+_quantity_attributes = {'value': 'value', 'errpos': 'errpos', 'errneg': 'errneg', 'limit': 'limit',
+                        'quality': 'quality', 'ref': 'reference'}
+_quantity_fills = {'value': (nan, float), 'errpos': (nan, float), 'errneg': (nan, float), 'limit': ('', 'U1'),
+                   'quality': (nan, float), 'ref': (None, object)}
+
+
+# warnings caught in each thread by Catalog._choose_parallel
+_caught = threading.local()
+
+
+@contextmanager
+def _thread_warnings():
+    """Within the context, warnings issued in a thread that has set _caught.warnings to a list go to that list
+    instead of being shown (catch_warnings itself can't be used from more than one thread at once)."""
+    with warnings.catch_warnings():
+        warnings.simplefilter('always')
+        show = warnings.showwarning
+
+        def showwarning(message, category, filename, lineno, file=None, line=None):
+            caught = getattr(_caught, 'warnings', None)
+            if caught is None:
+                show(message, category, filename, lineno, file, line)
+            else:
+                caught.append(message)
+
+        warnings.showwarning = showwarning
+        yield
+
+
+def _choose_batch(chooser, groups, threaded=False):
+    """Run the chooser on each list of measurements, returning the index of the chosen measurement in the list
+    (or the measurement itself if it isn't one of them, or None if none was chosen) and the warnings issued."""
+    results = []
+    for msmts in groups:
+        chosen, caught = _run_chooser(chooser, msmts, threaded)
+        if chosen is not None:
+            chosen = next((i for i, m in enumerate(msmts) if m is chosen), chosen)
+        results.append((chosen, caught))
+    return results
+
+
+def _run_chooser(chooser, msmts, threaded=False):
+    """Return the measurement the chooser picks (None if it doesn't pick one) and any warnings it issued. A
+    Pipeline reports ties itself, so doesn't need its warnings caught."""
+    if isinstance(chooser, choosers.Pipeline):
+        chosen, tied = chooser.choose(msmts)
+        return chosen, chooser.tie_warnings(tied)
+    if threaded:
+        _caught.warnings = []
+        try:
+            chosen = chooser(msmts)
+        finally:
+            caught, _caught.warnings = _caught.warnings, None
+    else:
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            chosen = chooser(msmts)
+        caught = [x.message for x in w]
+    if chosen is None or chosen == []:
+        chosen = None
+    return chosen, caught
+
+
+def _warn_arbitrary(arbitrary_picks):
+    instrumentation.count('arbitrary_picks', len(arbitrary_picks))
+    if len(arbitrary_picks) > 0:
+        msg = ('\nCould not select a "best" measurement according to the '
+               'catalog\'s chooser for the following:')
+        arbitrary_picks = [ap[2:] for ap in sorted(arbitrary_picks)]
+        for ap in arbitrary_picks:
+            msg += ('\n    {}: {}'.format(*ap))
+        warn(msg)
+
+
+def _unmasked(array):
+    # a plain array with masked entries filled in the way pandas expects
+    if not array.mask.any():
+        return array.data
+    if array.dtype.kind == 'f':
+        return array.filled(nan)
+    if array.dtype.kind in 'iub':
+        return array.astype(float).filled(nan)
+    data = array.data.astype(object)
+    data[array.mask] = None
+    return data
+
+
+def _atomic_write(path, s):
+    tmp_path = '{}.{}.tmp'.format(path, getpid())
+    try:
+        with open(tmp_path, 'wb' if isinstance(s, bytes) else 'w') as f:
+            f.write(s)
+        replace(tmp_path, path)
+    except BaseException:
+        if exists(tmp_path):
+            remove(tmp_path)
+        raise
+
+
+class Tracked(object):
+    """Keeps a flag for whether the object has been modified since it was last read or written. Setting any
+    attribute marks the object as modified and passes the change up to its parent (Measurement -> Property ->
+    Object)."""
+    __slots__ = ()
+    _untracked = {'_modified', '_parent'}
+    _modified = True
+    _parent = None
+
+    def __setattr__(self, key, value):
+        object.__setattr__(self, key, value)
+        if key not in self._untracked:
+            self._touch()
+
+    def __delattr__(self, key):
+        object.__delattr__(self, key)
+        if key not in self._untracked:
+            self._touch()
+
+    def _touch(self, child=None):
+        object.__setattr__(self, '_modified', True)
+        if self._parent is not None:
+            self._parent._touch(self)
+
+    def _adopt(self, child):
+        object.__setattr__(child, '_parent', self)
+
+    def _mark_clean(self):
+        object.__setattr__(self, '_modified', False)
+
+    def _state(self):
+        return {k: v for k, v in self.__dict__.items() if k not in self._untracked}
+
+    @property
+    def modified(self):
+        return bool(self._modified)
+
+
+class Extensible(Tracked):
+    __slots__ = ()
+
     def __init__(self, **kws):
         for key, val in kws.items():
             self.__setattr__(key, val)
 
 
+def _orderable(value):
+    # real numbers that aren't nan can go in the sorted part of a _ValueIndex
+    return (isinstance(value, (int, float, np.integer, np.floating)) and not isinstance(value, (bool, np.bool_))
+            and value == value)
+
+
+class _ValueIndex(object):
+    """The chosen values of one property across a catalog, kept sorted separately for each limit flag so that a
+    range can be found by bisection. Values that aren't numbers (or are nan) are kept aside and can only be
+    matched exactly. Objects whose property changed are marked stale and brought up to date before the next
+    lookup."""
+
+    def __init__(self):
+        # limit flag: (sorted values, names of the objects they belong to)
+        self.sorted = {flag: ([], []) for flag in '<=>'}
+        self.other = {}
+        # object name: (value, limit) of everything in the index
+        self.entries = {}
+        self.stale = set()
+
+    def update(self, chosen):
+        """Replace the entries of the objects in chosen, a dict of object name: chosen measurement (None for
+        objects that no longer have one)."""
+        if len(chosen) > len(self.entries)//8:
+            # cheaper to sort everything again than to insert one at a time
+            for name, msmt in chosen.items():
+                self.entries.pop(name, None)
+                if msmt is not None:
+                    self.entries[name] = msmt.value, msmt.limit
+            self._rebuild()
+            return
+        for name, msmt in chosen.items():
+            self._remove(name)
+            if msmt is not None:
+                self._insert(name, msmt.value, msmt.limit)
+
+    def _rebuild(self):
+        items = {flag: [] for flag in '<=>'}
+        self.other = {}
+        for name, (value, limit) in self.entries.items():
+            if _orderable(value):
+                items[limit].append((value, name))
+            else:
+                self.other[name] = value, limit
+        for flag, pairs in items.items():
+            pairs.sort(key=lambda pair: pair[0])
+            self.sorted[flag] = [v for v, _ in pairs], [n for _, n in pairs]
+
+    def _insert(self, name, value, limit):
+        self.entries[name] = value, limit
+        if _orderable(value):
+            values, names = self.sorted[limit]
+            i = bisect_right(values, value)
+            values.insert(i, value)
+            names.insert(i, name)
+        else:
+            self.other[name] = value, limit
+
+    def _remove(self, name):
+        entry = self.entries.pop(name, None)
+        if entry is None:
+            return
+        if name in self.other:
+            del self.other[name]
+            return
+        value, limit = entry
+        values, names = self.sorted[limit]
+        i = bisect_left(values, value) + names[bisect_left(values, value):bisect_right(values, value)].index(name)
+        del values[i]
+        del names[i]
+
+    def between(self, low, high, limits):
+        """Names of the objects with a value from low to high (inclusive, None for no bound) and one of the
+        limits flags."""
+        found = set()
+        for flag in limits:
+            values, names = self.sorted[flag]
+            i = 0 if low is None else bisect_left(values, low)
+            j = len(values) if high is None else bisect_right(values, high)
+            found.update(names[i:j])
+        return found
+
+    def equal(self, value, limits):
+        if _orderable(value):
+            return self.between(value, value, limits)
+        return {name for name, (v, limit) in self.other.items() if limit in limits and v == value}
+
+
+class ReferenceTable(object):
+    """The citations used in a catalog, each with an integer id and, optionally, metadata like a bibcode or year.
+    Ids are given out in the order citations are added and are kept when the table is saved with the catalog.
+
+    Measurements keep their reference as a string, but strings read from files are interned, so every measurement
+    citing the same source (and the table) shares one copy of it."""
+
+    def __init__(self, citations=(), metadata=None):
+        self.citations = []
+        self._ids = {}
+        self._metadata = {}
+        for citation in citations:
+            self.add(citation)
+        for i, md in (metadata or {}).items():
+            self._metadata[int(i)] = dict(md)
+
+    def add(self, citation, **metadata):
+        """Add citation if it isn't in the table yet, update its metadata with any keywords, and return its id."""
+        i = self._ids.get(citation)
+        if i is None:
+            i = len(self.citations)
+            citation = sys.intern(citation)
+            self.citations.append(citation)
+            self._ids[citation] = i
+        if metadata:
+            self._metadata.setdefault(i, {}).update(metadata)
+        return i
+
+    def intern(self, citation):
+        """The table's copy of citation (added if need be)."""
+        return self.citations[self.add(citation)]
+
+    def id(self, citation):
+        return self._ids[citation]
+
+    def metadata(self, citation):
+        return dict(self._metadata.get(self._ids[citation], {}))
+
+    def update(self, objects):
+        """Add the references of every measurement of objects, pointing the measurements at the table's copy of
+        each string."""
+        for obj in objects:
+            for prop in obj.properties:
+                for msmt in prop.measurements:
+                    ref = msmt.reference
+                    if type(ref) is str:
+                        _measurement_setters[2](msmt, self.intern(ref))
+
+    def __getitem__(self, id):
+        return self.citations[id]
+
+    def __contains__(self, citation):
+        return citation in self._ids
+
+    def __iter__(self):
+        return iter(self.citations)
+
+    def __len__(self):
+        return len(self.citations)
+
+    def json_ready(self):
+        return {'citations': self.citations,
+                'metadata': {str(i): md for i, md in sorted(self._metadata.items())}}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['citations'], d['metadata'])
+
+    def save(self, path):
+        _atomic_write(path, json.dumps(self.json_ready(), indent=4))
+
+    @classmethod
+    def load(cls, path):
+        """Load the table saved at path, or return None if there isn't one."""
+        try:
+            with open(path) as f:
+                return cls.from_dict(json.load(f))
+        except FileNotFoundError:
+            return None
+
+
 class Catalog(object):
+    quantities = ('value', 'errpos', 'errneg', 'limit', 'quality', 'ref')
+
+    # filename: (mtime_ns, size, sha1 digest or None) of the files in the directory the catalog is synced with
+    _manifest = None
+    # a ReferenceTable, made the first time the references attribute is used or read along with the catalog
+    _references = None
+    # made anew whenever the catalog is synced with a (different) directory. Objects are marked clean with the
+    # token of the catalog that saved (or read) them, so a write by another catalog doesn't make an object look
+    # saved to this one's directory
+    _sync_token = None
+    # the directory a catalog read with only some properties came from, which it mustn't be written over
+    _projected_from = None
+
     def __init__(self, objects=None, chooser='default'):
+        self._synced_path = None
+        self._deleted = set()
+        self._journaled = set()
+        self._chosen = {}
+        self._cache_hits = 0
+        self._cache_misses = 0
+        self._index = None
+        self._value_indexes = {}
+        self._references_stale = set()
         self.objects = objects
         self.chooser = chooser
         if type(chooser) is str:
@@ -65,49 +430,618 @@ class Catalog(object):
                 self._chooser = choosers.__dict__[value]
             except KeyError:
                 raise KeyError('{} is not a chooser defined in the choosers module.'.format(value))
+        elif type(value) in (list, tuple):
+            self._chooser = choosers.Pipeline(value)
         elif hasattr(value, '__call__'):
             self._chooser = value
         else:
-            raise ValueError('Chooser can only be set with a string matching the name of a function in the choosers module or a user-defined function.')
+            raise ValueError('Chooser can only be set with a string matching the name of a function in the choosers module, a list of steps for a choosers.Pipeline, or a user-defined function.')
+        self._chosen = {}
+        self._value_indexes = {}
 
+    @property
+    def references(self):
+        """The catalog's ReferenceTable. Using this adds any citations that aren't in the table yet from the
+        objects added or changed since it was last used (and for a Catalog, the objects it was read with), without
+        going through the rest. The table is saved in a references.json file when the catalog is written. Use
+        sync_references to go through every object, e.g. after files were changed outside deepcat."""
+        if self._references is None:
+            self._references = ReferenceTable()
+        stale, self._references_stale = self._references_stale, set()
+        objects = (self._objects.get(name) for name in stale)
+        self._references.update(obj for obj in objects if obj is not None)
+        return self._references
+
+    def sync_references(self):
+        """Add the citations of every measurement of the catalog to its ReferenceTable (reading every object of a
+        LazyCatalog) and return the table."""
+        if self._references is None:
+            self._references = ReferenceTable()
+        self._references_stale = set()
+        self._references.update(self._objects.values())
+        return self._references
+
+    @property
+    def cache_info(self):
+        """Hits, misses, and current size of the cache of chosen measurements."""
+        entries = sum(len(cache) for cache in self._chosen.values())
+        return {'hits': self._cache_hits, 'misses': self._cache_misses, 'entries': entries}
+
+    def clear_cache(self):
+        self._chosen = {}
+        self._value_indexes = {}
+        self._cache_hits = 0
+        self._cache_misses = 0
+
+    def _choose(self, obj, name):
+        """Return the measurement of obj's name property picked by the chooser (None if it has no measurements)
+        and a list of any warnings the chooser issued. Results are cached until the property is changed or
+        replaced (editing its list of measurements in place included) or the chooser is reassigned."""
+        prop = obj[name]
+        cache = self._chosen.setdefault(obj.name, {})
+        entry = cache.get(name)
+        if entry is not None and entry[0] is prop:
+            self._cache_hits += 1
+            return entry[1], entry[2]
+
+        self._cache_misses += 1
+        msmt, caught = None, []
+        if len(prop.measurements) > 0:
+            with instrumentation.stage('choose'):
+                msmt, caught = _run_chooser(self.chooser, prop.measurements)
+            instrumentation.count('chooser_calls')
+        cache[name] = prop, msmt, caught
+        return msmt, caught
+
+    def _choose_parallel(self, properties, workers=None, pool='process'):
+        """Run the chooser on the given properties of every object that has them and isn't already in the cache
+        of chosen measurements, splitting the objects among workers processes (pool='process') or threads
+        (pool='thread'), and put the results in the cache. This is only worth it for choosers that take a lot
+        of time. Processes are given copies of the measurements without their parent property and object, and
+        if the chooser can't be pickled threads are used instead. Does nothing if workers is None or 1."""
+        if workers is None or workers <= 1:
+            return
+        if pool not in ('process', 'thread'):
+            raise ValueError('pool must be "thread" or "process".')
+        if pool == 'process':
+            try:
+                pickle.dumps(self.chooser)
+            except (pickle.PicklingError, AttributeError, TypeError):
+                pool = 'thread'
+
+        property_index = self._property_index()
+        todo = []
+        for name in properties:
+            for oname in property_index.get(name, ()):
+                obj = self._objects[oname]
+                prop = obj[name]
+                entry = self._chosen.get(oname, {}).get(name)
+                if (entry is None or entry[0] is not prop) and len(prop.measurements) > 0:
+                    todo.append((obj, name, prop))
+        if len(todo) == 0:
+            return
+
+        if pool == 'process':
+            new = Measurement._trusted
+            groups = [[new(m.value, m._error, m.reference, m._limit, m._quality, m._custom)
+                       for m in prop.measurements] for _, _, prop in todo]
+            executor, capture = ProcessPoolExecutor(workers), nullcontext()
+        else:
+            groups = [prop.measurements for _, _, prop in todo]
+            executor, capture = ThreadPoolExecutor(workers), _thread_warnings()
+        size = -(-len(groups)//(4*workers))
+        chunks = [groups[i:i + size] for i in range(0, len(groups), size)]
+        with instrumentation.stage('choose'), capture, executor:
+            results = executor.map(_choose_batch, repeat(self.chooser), chunks, repeat(pool == 'thread'))
+            results = [result for chunk in results for result in chunk]
+
+        for (obj, name, prop), (chosen, caught) in zip(todo, results):
+            msmt = prop.measurements[chosen] if type(chosen) is int else chosen
+            self._chosen.setdefault(obj.name, {})[name] = prop, msmt, caught
+        self._cache_misses += len(todo)
+        instrumentation.count('chooser_calls', len(todo))
+
+    def _object_changed(self, obj, name=None):
+        # called by objects in the catalog whenever they (or their properties or measurements) change
+        if self._objects.get(obj.name) is not obj:
+            return
+        self._references_stale.add(obj.name)
+        if name is None or name not in obj:
+            # can't be journaled as a change to a single property
+            self._pending.add(obj.name)
+        if name is None:
+            self._chosen.pop(obj.name, None)
+            self._unindex(obj.name)
+            self._reindex(obj)
+            self._mark_stale(obj.name)
+        else:
+            if obj.name in self._chosen:
+                self._chosen[obj.name].pop(name, None)
+            self._mark_stale(obj.name, name)
+            if self._index is not None:
+                if name in obj:
+                    self._index.setdefault(name, set()).add(obj.name)
+                else:
+                    self._unindex(obj.name, [name])
+
+    def _register(self, obj):
+        obj._add_catalog(self)
+        self._references_stale.add(obj.name)
+        self._chosen.pop(obj.name, None)
+        self._reindex(obj)
+        self._mark_stale(obj.name)
+
+    def _unregister(self, obj):
+        obj._discard_catalog(self)
+        self._chosen.pop(obj.name, None)
+        self._unindex(obj.name)
+        self._mark_stale(obj.name)
+
+    def _mark_stale(self, object_name, property_name=None):
+        # the value indexes are brought up to date for these objects the next time they are used
+        if property_name is None:
+            for index in self._value_indexes.values():
+                index.stale.add(object_name)
+        elif property_name in self._value_indexes:
+            self._value_indexes[property_name].stale.add(object_name)
+
+    def _value_index(self, name):
+        """The _ValueIndex of the chosen values of property name. It is built the first time it's needed and then
+        updated for just the objects that changed since it was last used."""
+        index = self._value_indexes.get(name)
+        if index is None:
+            index = self._value_indexes[name] = _ValueIndex()
+            index.stale = set(self._property_index().get(name, ()))
+        if index.stale:
+            chosen = {}
+            for oname in index.stale:
+                obj = self._objects[oname] if oname in self._objects else None
+                msmt = None
+                if obj is not None and name in obj:
+                    msmt, caught = self._choose(obj, name)
+                    for message in caught:
+                        warn(message)
+                chosen[oname] = msmt
+            index.update(chosen)
+            index.stale = set()
+        return index
+
+    def query(self, where=None, limits='=', **predicates):
+        """Names (sorted) of the objects whose chosen values match all the predicates, given as keywords (or a
+        where dictionary, for property names that aren't valid keywords) of property name: condition. A
+        condition of (low, high) matches values from low to high inclusive, with None for no bound, and anything
+        else is matched exactly. E.g.
+
+            cat.query(teff=(3000, 4000), radius=(None, 0.5))
+
+        Only chosen values that are limits with a flag in limits match, so by default upper and lower limits are
+        left out. Use limits='=<' to count upper limits as well, say.
+
+        Each property is looked up in a sorted index of its chosen values that is kept until the chooser is
+        changed and updated only for the objects that change."""
+        if where is not None:
+            predicates = {**where, **predicates}
+        if not set(limits) <= set('<=>'):
+            raise ValueError('limits can only contain the flags <, =, and >.')
+        found = None
+        for name, condition in predicates.items():
+            index = self._value_index(name)
+            if type(condition) in (tuple, list):
+                low, high = condition
+                matches = index.between(low, high, limits)
+            else:
+                matches = index.equal(condition, limits)
+            found = matches if found is None else found & matches
+            if not found:
+                break
+        if found is None:
+            return self.object_names
+        return sorted(found)
+
+    def _property_index(self):
+        """Mapping of each property name to the set of names of the objects that have that property. It is built
+        the first time it's needed and kept up to date from then on."""
+        if self._index is None:
+            index = {}
+            for oname, obj in self._objects.items():
+                for name in obj.property_names:
+                    index.setdefault(name, set()).add(oname)
+            self._index = index
+        return self._index
+
+    def _reindex(self, obj):
+        if self._index is not None:
+            for name in obj.property_names:
+                self._index.setdefault(name, set()).add(obj.name)
+
+    def _unindex(self, object_name, property_names=None):
+        if self._index is None:
+            return
+        if property_names is None:
+            property_names = list(self._index.keys())
+        for name in property_names:
+            onames = self._index.get(name)
+            if onames is not None:
+                onames.discard(object_name)
+                if len(onames) == 0:
+                    del self._index[name]
+
+    def to_store(self):
+        """Return a columnar copy of the catalog's measurements (see the columnar module). Later changes to either
+        one don't show up in the other. To keep just the columns in memory instead of this catalog, make a
+        columnar.StoreCatalog from the store and drop the catalog."""
+        from .columnar import MeasurementStore
+        return MeasurementStore.from_catalog(self)
+
+    def write_packed(self, path):
+        """Save the whole catalog to a single packed binary file (see the columnar module). This is quicker to
+        load and ship around than the directory of .object files, but isn't meant for version control."""
+        self.to_store().save(path)
 
-    def choose(self, property, object='all', quantity='value', default=None):
+    @classmethod
+    def read_packed(cls, path, mmap=False, properties=None, lazy=False, cache_size=1024):
+        """Read a catalog saved with write_packed. See read for properties. With lazy=True, this returns a
+        columnar.StoreCatalog that only builds objects from the columns of the file when they are used (keeping
+        up to cache_size of them), which with mmap=True means hardly anything is read up front."""
+        from .columnar import MeasurementStore, StoreCatalog
+        store = MeasurementStore.load(path, mmap=mmap)
+        if lazy:
+            return StoreCatalog(store, cache_size, properties=properties)
+        return store.to_catalog(properties=properties)
+
+    def choose(self, property, object='all', quantity='value', default=None, workers=None, pool='process'):
+        """The quantity of the chosen measurement of property for object (or a list for all objects). See
+        _choose_parallel for workers and pool."""
         if object == 'all':
+            self._choose_parallel([property], workers, pool)
             values = [self.choose(property, o, quantity, default) for o in self.object_names]
             return values
         else:
-            msmts = self[object][property].measurements
-            chosen_msmt = self.chooser(msmts)
-            if chosen_msmt == []:
+            chosen_msmt, caught = self._choose(self[object], property)
+            for message in caught:
+                warn(message)
+            if chosen_msmt is None:
                 return default
             value = getattr(chosen_msmt, quantity)
             return value
 
     @classmethod
     def _get_obj_paths(self, dir):
-        search_str = pathjoin(dir, '*.object')
-        paths = glob(search_str)
-        return sorted(paths)
-
-    def write(self, path, overwrite=False):
+        paths = glob(pathjoin(glob_escape(dir), '*.object'))
+        layout = _read_layout(dir)
+        if layout['layout'] == 'sharded':
+            # files at the top level are read too, so a catalog part way through migrate_layout is still whole
+            shard = '[0-9a-f]'*layout['prefix_length']
+            paths += glob(pathjoin(glob_escape(dir), shard, '*.object'))
+        return sorted(paths, key=basename)
+
+    @staticmethod
+    def migrate_layout(path, layout='sharded'):
+        """Move the object files of the catalog in the directory at path into the given layout ('flat' or
+        'sharded', see write). The files are only moved, not read."""
+        if layout not in _layouts:
+            raise ValueError('layout must be one of {}.'.format(_layouts))
+        obj_paths = Catalog._get_obj_paths(path)
+        spec = _layout_spec(layout)
+        if layout == 'sharded':
+            # mark the directory first, so that all the files are still found if this gets interrupted
+            _write_layout(path, spec)
+        for opath in obj_paths:
+            new_path = pathjoin(path, _object_relpath(_object_name(basename(opath)), spec))
+            if abspath(new_path) != abspath(opath):
+                makedirs(dirname(new_path), exist_ok=True)
+                replace(opath, new_path)
+        if layout == 'flat':
+            for shard in set(dirname(opath) for opath in obj_paths):
+                if abspath(shard) != abspath(path) and len(listdir(shard)) == 0:
+                    rmdir(shard)
+            if exists(pathjoin(path, _layout_file)):
+                remove(pathjoin(path, _layout_file))
+
+    def write(self, path, overwrite=False, layout=None, journal=False):
+        """Save the catalog as one .object file per object. When overwriting the directory the catalog was last
+        read from or written to, only the files of objects that were modified, added, or removed since then are
+        touched. Each file is written to a temporary file first and then renamed into place.
+
+        With layout='flat' all the files go directly in path. With layout='sharded' they go in subdirectories
+        named by the first two hex digits of a hash of the object name, which keeps directory listings (and git)
+        quick for very large catalogs. By default a new directory is flat and an existing one keeps its layout.
+        Use Catalog.migrate_layout to change the layout of an existing directory. Characters in object names that
+        aren't safe in filenames (like /) are %-escaped.
+
+        With journal=True, writing back to the directory the catalog was read from (or last written to) doesn't
+        touch the object files at all. Instead, the changes since then (added measurements, replaced properties,
+        and added, replaced or deleted objects) are appended to a journal.jsonl file in the directory in one
+        batch that is only applied if it was written completely. read replays the journal over the object
+        files, skipping records for files that were rewritten since (as by a compaction that was cut short). A
+        plain write (or compact) folds it back into the files. Anywhere else, journal is ignored."""
+        if layout is not None and layout not in _layouts:
+            raise ValueError('layout must be one of {}.'.format(_layouts))
+        if self._projected_from == abspath(path):
+            raise ValueError('The catalog was read from {} with only some of its properties, so writing it back '
+                             'there would lose the rest. Write it somewhere else.'.format(path))
+        synced = self._synced_path == abspath(path)
         if exists(path):
             if overwrite:
-                obj_paths = self._get_obj_paths(path)
-                for opath in obj_paths:
-                    remove(opath)
+                if journal and synced:
+                    self._append_journal(path)
+                    self._write_references(path)
+                    return
                 print("Updating object files in specified path. You might want to do a Git commit or equivalent in the directory you specified.")
             else:
                 raise ValueError('Path exists. User overwrite=True ot overwrite.')
+            spec = _read_layout(path)
+            if layout is not None and layout != spec['layout']:
+                raise ValueError('The catalog at {} has a {} layout. Use Catalog.migrate_layout to change it.'
+                                 ''.format(path, spec['layout']))
         else:
             mkdir(path)
             print("Created a new directory for the catalog at \n{}\nYou might want to initiliaze a version control system in that directory now.".format(path))
-
-        for obj in self.objects:
-            obj_filename = '{}.object'.format(obj.name)
+            spec = _layout_spec(layout or 'flat')
+            if spec['layout'] != 'flat':
+                _write_layout(path, spec)
+
+        existing = {relpath(opath, path): opath for opath in self._get_obj_paths(path)}
+        objects = self._loaded_objects() if synced else self._objects.values()
+        if not synced:
+            self._sync_token = object()
+        # objects with journal entries have to be written out so the journal can go
+        rewrite = self._pending | self._journaled if synced else None
+        manifest = dict(self._manifest or {}) if synced else {}
+        made_dirs = set()
+        arrays = {}
+        for obj in objects:
+            obj_filename = _object_relpath(obj.name, spec)
+            if synced and obj_filename in existing and self._is_clean(obj) and obj.name not in rewrite:
+                continue
             obj_path = pathjoin(path, obj_filename)
-            s = obj.to_json()
-            with open(obj_path, 'w') as f:
-                f.write(s)
+            if spec['layout'] == 'sharded' and dirname(obj_filename) not in made_dirs:
+                makedirs(dirname(obj_path), exist_ok=True)
+                made_dirs.add(dirname(obj_filename))
+            with instrumentation.stage('write.serialize'):
+                s = obj.to_json(arrays)
+            with instrumentation.stage('write.io'):
+                if arrays:
+                    _save_arrays(path, arrays)
+                    arrays.clear()
+                _atomic_write(obj_path, s)
+            manifest[obj_filename] = _file_stat(obj_path) + (None,)
+            instrumentation.count('files_written')
+            instrumentation.count('bytes_written', len(s))
+            obj._mark_clean(self._sync_token)
+
+        # whatever is left on disk belongs to objects no longer in the catalog
+        for name in self._objects.keys():
+            existing.pop(_object_relpath(name, spec), None)
+        for filename, opath in existing.items():
+            remove(opath)
+            manifest.pop(filename, None)
+        if exists(pathjoin(path, _journal_file)):
+            remove(pathjoin(path, _journal_file))
+        self._write_references(path)
+
+        self._pending = set()
+        self._deleted = set()
+        self._journaled = set()
+        self._synced_path = abspath(path)
+        self._manifest = manifest
+
+    def _is_clean(self, obj):
+        """Whether obj is unchanged since this catalog last read or saved it in the directory it is synced with."""
+        return obj._clean_token is self._sync_token and not obj.modified
+
+    def _write_references(self, path):
+        if self._references is not None:
+            self.references.save(pathjoin(path, _references_file))
+
+    def _append_journal(self, path):
+        records = [{'op': 'delete_object', 'object': name} for name in sorted(self._deleted)]
+        objects = [obj for obj in self._loaded_objects() if not self._is_clean(obj) or obj.name in self._pending]
+        arrays = {}
+        for obj in objects:
+            if obj.name in self._pending or obj._clean_token is not self._sync_token:
+                # the flags of what changed were reset by a write elsewhere, so save the whole object
+                records.append({'op': 'set_object', 'object': obj.json_ready(arrays)})
+                continue
+            for prop in obj.properties:
+                if not prop.modified:
+                    continue
+                if prop._modified == 'appended':
+                    n = len(prop.measurements)
+                    while n > 0 and prop.measurements[n - 1].modified:
+                        n -= 1
+                    for msmt in prop.measurements[n:]:
+                        d = msmt._state()
+                        if msmt._custom is not None:
+                            _stash_arrays(d, arrays)
+                        records.append({'op': 'add_measurement', 'object': obj.name, 'property': prop.name,
+                                        'measurement': d})
+                else:
+                    records.append({'op': 'set_property', 'object': obj.name, 'property': prop.json_ready(arrays)})
+        if len(records) == 0:
+            return
+        _save_arrays(path, arrays)
+
+        # the begin record tells replay to drop whatever is left of a batch that a crash cut short, even one that
+        # was cut between two lines. It also has the digests of the files the records apply to, so that replay
+        # can skip records that a compaction cut short by a crash already folded into the files
+        spec = _read_layout(path)
+        files = {name: _object_file_digest(path, name, spec) for name in map(_record_object_name, records)}
+        begin = {'op': 'begin', 'files': files}
+        lines = [json.dumps(record) for record in [begin] + records + [{'op': 'commit'}]]
+        with instrumentation.stage('write.io'):
+            with open(pathjoin(path, _journal_file), 'a+b') as f:
+                # start on a fresh line if a crash left part of a batch at the end
+                if f.tell() > 0:
+                    f.seek(-1, 2)
+                    if f.read(1) != b'\n':
+                        f.write(b'\n')
+                f.write(('\n'.join(lines) + '\n').encode('utf-8'))
+                f.flush()
+                fsync(f.fileno())
+        instrumentation.count('journal_records', len(records))
+
+        for obj in objects:
+            obj._mark_clean(self._sync_token)
+        self._journaled |= set(self._deleted) | {obj.name for obj in objects}
+        self._pending = set()
+        self._deleted = set()
+
+    def compact(self):
+        """Fold the journal of the directory the catalog was read from into its object files (rewriting only
+        the files of objects that have journal entries or unsaved changes) and remove it."""
+        if self._synced_path is None:
+            raise ValueError('The catalog was not read from or written to a directory, so there is no journal '
+                             'to compact.')
+        self.write(self._synced_path, overwrite=True)
+
+    def _replay_journal(self, path, properties=None):
+        """Apply the complete batches of records in the journal of the catalog directory at path."""
+        journal_path = pathjoin(path, _journal_file)
+        if not exists(journal_path):
+            return
+        records, batch, files = [], [], None
+        with open(journal_path, encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # part of a batch that was cut short
+                    batch = []
+                    continue
+                if record['op'] == 'commit':
+                    records.extend((record, files) for record in batch)
+                    batch = []
+                elif record['op'] == 'begin':
+                    batch, files = [], record.get('files')
+                else:
+                    batch.append(record)
+
+        spec = _read_layout(path)
+        digests = {}
+        touched = set()
+        for record, files in records:
+            name = _record_object_name(record)
+            if files is not None and name in files:
+                if name not in digests:
+                    digests[name] = _object_file_digest(path, name, spec)
+                if digests[name] != files[name]:
+                    # the file was rewritten since the record was journaled, so it already has the change
+                    continue
+            name = self._apply_record(record, properties, abspath(path))
+            if name is not None:
+                touched.add(name)
+        for name in touched:
+            if name in self:
+                self[name]._mark_clean(self._sync_token)
+        self._pending = set()
+        self._deleted = set()
+        self._journaled = touched
+
+    def _apply_record(self, record, properties=None, root=None):
+        op = record['op']
+        if op == 'delete_object':
+            name = record['object']
+            if name in self:
+                del self[name]
+            return name
+        if op == 'set_object':
+            obj = Object.from_dict(record['object'], trusted=True, properties=properties, root=root)
+            if len(obj) > 0 or properties is None:
+                self.add_object(obj)
+            elif obj.name in self:
+                del self[obj.name]
+            return obj.name
+
+        name = record['object']
+        pname = record['property'] if op == 'add_measurement' else record['property']['name']
+        if properties is not None and pname not in properties:
+            return None
+        if name in self:
+            obj = self[name]
+        else:
+            obj = Object(name)
+            self.add_object(obj)
+        if op == 'set_property':
+            obj[pname] = Property.from_dict(record['property'], trusted=True, root=root)
+        elif op == 'add_measurement':
+            if pname not in obj:
+                obj[pname] = Property(pname)
+            prop = obj[pname]
+            dprop = {'name': pname, 'measurements': [record['measurement']]}
+            prop.measurements.append(Property.from_dict(dprop, True, root).measurements[0])
+        else:
+            raise ValueError('Unknown journal record {}.'.format(op))
+        return name
+
+    def refresh(self):
+        """Bring the catalog up to date with changes made to the files in the directory it was read from (or last
+        written to) since then, e.g. by a git pull. Only files whose mtime or size changed are looked at, and only
+        those whose content also changed are parsed again. Objects whose files were deleted are dropped. Raises a
+        ValueError, changing nothing, if any object with unsaved changes was also changed on disk. Returns the
+        names of the objects that were updated, added, or dropped."""
+        if self._synced_path is None:
+            raise ValueError('The catalog was not read from or written to a directory, so there is nothing to '
+                             'refresh it from.')
+        path = self._synced_path
+        if exists(pathjoin(path, _journal_file)):
+            raise ValueError('The catalog directory has a journal. Compact it first.')
+        old = self._manifest or {}
+        manifest, changed = _scan_files(path, old)
+        removed = set(old) - set(manifest)
+
+        names = {filename: _object_name(basename(filename)) for filename in changed | removed}
+        conflicts = []
+        for name in names.values():
+            obj = self._objects.get(name)
+            if name in self._pending or (obj is not None and not self._is_clean(obj)):
+                conflicts.append(name)
+        if conflicts:
+            raise ValueError('These objects have unsaved changes and were also changed on disk: {}'
+                             ''.format(', '.join(sorted(conflicts))))
+
+        for filename in sorted(removed):
+            if names[filename] in self._objects:
+                self._forget(names[filename])
+        for filename in sorted(changed):
+            self._reload(names[filename], pathjoin(path, filename))
+        self._manifest = manifest
+        return sorted(names.values())
+
+    def _reload(self, name, path):
+        obj = _read_object(path)
+        obj._mark_clean(self._sync_token)
+        old = self._objects.get(name)
+        if old is not None:
+            self._unregister(old)
+        self._objects[name] = obj
+        self._register(obj)
+
+    def _forget(self, name):
+        self._unregister(self._objects.pop(name))
+
+    def _loaded_objects(self):
+        # objects that are in memory and so might have been changed
+        return self._objects.values()
+
+    def __setstate__(self, d):
+        # objects don't pickle their links back to catalogs, so restore them
+        self.__dict__.update(d)
+        for obj in self._loaded_objects():
+            obj._add_catalog(self)
+
+    @classmethod
+    def open(cls, path, lazy=False, cache_size=1024, properties=None):
+        """Open the catalog saved in the directory at path. With lazy=False this is the same as read. With
+        lazy=True, nothing is parsed up front: object names come from the filenames and each object is read the
+        first time it is accessed, with at most cache_size unmodified objects kept in memory (see LazyCatalog).
+        See read for properties."""
+        if lazy:
+            return LazyCatalog(path, cache_size=cache_size, properties=properties)
+        else:
+            return cls.read(path, properties=properties)
 
     @classmethod
     def empty_catalog(cls, object_names, property_names):
@@ -120,27 +1054,178 @@ class Catalog(object):
         return Catalog(objects)
 
     def add_measurements(self, object_names, property_name, values, errors=None, references=None, limits=None, qualities=None):
-        errors = [None]*len(self) if errors is None else errors
+        n = len(object_names)
+        errors = [None]*n if errors is None else errors
         if references is None:
-            references = [None]*len(self)
+            references = [None]*n
         if type(references) is str:
-            references = [references]*len(self)
-        limits = ['=']*len(self) if limits is None else limits
-        qualities = [None]*len(self) if qualities is None else qualities
+            references = [references]*n
+        limits = ['=']*n if limits is None else limits
+        qualities = [None]*n if qualities is None else qualities
         args = zip(object_names, values, errors, references, limits, qualities)
         for name, v, e, r, l, q in args:
             self[name].add_measurement(property_name, v, e, r, l, q)
 
+    def ingest_table(self, table, object_column, property_map, reference=None, create_objects=True):
+        """Add measurements from whole columns of a table at once. table can be an astropy Table, a dictionary of
+        arrays or lists, or anything else that returns an array-like when indexed by a column name. Masked or nan
+        entries are treated as missing.
+
+        object_column names the column with the object names. property_map maps each property name to either
+        the name of the column with its values or a dictionary with some of the keys 'value', 'error' (a column
+        of symmetric errors or a (positive, negative) pair of columns), 'errpos' and 'errneg', 'limit',
+        'quality', and 'reference' giving column names. Rows with a missing value are skipped and reference is
+        used wherever there is no reference column (or it is masked).
+
+        All columns are validated before anything is added, and objects that are not yet in the catalog are
+        created (unless create_objects is False, in which case a KeyError is raised). Rows with no values at all
+        are ignored, so they don't make empty objects."""
+        names = _column(table, object_column)[0].tolist()
+        n = len(names)
+
+        # validate everything first so a bad column doesn't leave the catalog half updated
+        columns = {}
+        for prop_name, spec in property_map.items():
+            if type(spec) is str:
+                spec = {'value': spec}
+            columns[prop_name] = _ingest_columns(table, spec, n, reference)
+
+        # only rows with a value of at least one property need an object
+        used = np.zeros(n, bool)
+        for keep in columns.values():
+            used |= keep[0]
+        used = [name for name, use in zip(names, used.tolist()) if use]
+        missing = [name for name in dict.fromkeys(used) if name not in self._objects]
+        if len(missing) > 0:
+            if not create_objects:
+                raise KeyError('No {} object(s) in the catalog.'.format(', '.join(map(str, missing))))
+            for name in missing:
+                self.add_object(Object(name))
+
+        new = Measurement._trusted
+        for prop_name, (keep, values, errors, refs, limits, qualities) in columns.items():
+            added = {}
+            for i in np.flatnonzero(keep).tolist():
+                msmt = new(values[i], errors[i], refs[i], limits[i], qualities[i])
+                added.setdefault(names[i], []).append(msmt)
+            # a single change notification per property, rather than per measurement
+            for name, msmts in added.items():
+                obj = self._objects[name]
+                if prop_name not in obj:
+                    obj[prop_name] = Property(prop_name)
+                obj[prop_name].measurements.extend(msmts)
+
     @classmethod
-    def read(cls, path):
+    def read(cls, path, workers=None, pool='thread', chunksize=64, properties=None, cache=False):
+        """Read the catalog saved in the directory at path. If properties is a list of property names, only those
+        properties are built and objects that have none of them are skipped (most without being parsed at all).
+        Such a partial catalog isn't tied to path and can't be written back there, since that would lose the rest.
+
+        If cache is True, a snapshot of the parsed catalog is kept in a .deepcat_cache directory within path
+        (with a .gitignore that keeps git from picking it up) and later reads with cache=True only parse the
+        files that changed since, checking mtime and size and then a hash of the content. Files are then parsed
+        one at a time, and this can't be combined with properties."""
+        if cache:
+            if properties is not None:
+                raise ValueError('cache and properties can\'t be used together.')
+            return cls._read_cached(path)
         obj_paths = cls._get_obj_paths(path)
-        objs = []
-        for path in obj_paths:
-            with open(path) as f:
-                s = f.read()
-                obj = Object.from_json(s)
-                objs.append(obj)
-        return Catalog(objects=objs)
+        # stat the files before they're read, so that any change made during the read shows up in refresh
+        manifest = {relpath(opath, path): _file_stat(opath) + (None,) for opath in obj_paths}
+        objs = list(cls.iter_read(path, workers=workers, pool=pool, chunksize=chunksize, properties=properties))
+        catalog = Catalog(objects=objs)
+        if properties is None:
+            catalog._mark_synced(path, manifest)
+        else:
+            catalog._projected_from = abspath(path)
+        catalog._replay_journal(path, properties)
+        catalog._references = ReferenceTable.load(pathjoin(path, _references_file))
+        return catalog
+
+    @classmethod
+    def _read_cached(cls, path):
+        snapshot_path = pathjoin(path, _cache_dir, 'snapshot.pickle')
+        manifest, objects = {}, {}
+        try:
+            with open(snapshot_path, 'rb') as f:
+                snapshot = _unpickle(f)
+            if snapshot['version'] == _cache_version:
+                manifest, objects = snapshot['manifest'], snapshot['objects']
+        except Exception:
+            # missing, or made by a version of deepcat whose classes have since changed, so start over
+            manifest, objects = {}, {}
+
+        new_manifest, changed = _scan_files(path, manifest)
+        for filename in new_manifest:
+            if filename in changed or filename not in objects:
+                objects[filename] = _read_object(pathjoin(path, filename))
+            else:
+                instrumentation.count('files_from_cache')
+        objects = {filename: objects[filename] for filename in new_manifest}
+
+        if new_manifest != manifest:
+            makedirs(pathjoin(path, _cache_dir), exist_ok=True)
+            ignore_path = pathjoin(path, _cache_dir, '.gitignore')
+            if not exists(ignore_path):
+                # so git leaves the cache out without anyone having to tell it
+                with open(ignore_path, 'w') as f:
+                    f.write('*\n')
+            snapshot = {'version': _cache_version, 'manifest': new_manifest, 'objects': objects}
+            _atomic_write(snapshot_path, pickle.dumps(snapshot, protocol=pickle.HIGHEST_PROTOCOL))
+
+        catalog = Catalog(objects=list(objects.values()))
+        catalog._mark_synced(path, new_manifest)
+        catalog._replay_journal(path)
+        catalog._references = ReferenceTable.load(pathjoin(path, _references_file))
+        return catalog
+
+    def _mark_synced(self, path, manifest=None):
+        self._sync_token = object()
+        for obj in self._objects.values():
+            obj._mark_clean(self._sync_token)
+        self._pending = set()
+        self._deleted = set()
+        self._journaled = set()
+        self._synced_path = abspath(path)
+        self._manifest = manifest
+
+    @property
+    def modified(self):
+        return (len(self._pending) > 0 or len(self._deleted) > 0
+                or any(not self._is_clean(obj) for obj in self._loaded_objects()))
+
+    @classmethod
+    def iter_read(cls, path, workers=None, pool='thread', chunksize=64, properties=None):
+        """Yield the objects in a catalog directory as they are parsed, in the same (sorted) order that read
+        uses. If workers > 1, files are parsed by a pool of threads or processes (pool='thread' or 'process'),
+        handing out chunksize files at a time and keeping only a few chunks in flight at once. See read for
+        properties."""
+        obj_paths = cls._get_obj_paths(path)
+        if workers is None or workers <= 1:
+            for opath in obj_paths:
+                obj = _read_object(opath, properties)
+                if obj is not None:
+                    yield obj
+            return
+
+        if pool == 'thread':
+            executor = ThreadPoolExecutor(workers)
+        elif pool == 'process':
+            executor = ProcessPoolExecutor(workers)
+        else:
+            raise ValueError('pool must be "thread" or "process".')
+
+        chunks = (obj_paths[i:i + chunksize] for i in range(0, len(obj_paths), chunksize))
+        pending = deque()
+        try:
+            for chunk in chunks:
+                pending.append(executor.submit(_read_objects, chunk, properties))
+                if len(pending) >= 2*workers:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+        finally:
+            executor.shutdown(cancel_futures=True)
 
     @property
     def objects(self):
@@ -148,16 +1233,103 @@ class Catalog(object):
 
     def add_object(self, object):
         try:
+            if object.name in self._objects:
+                self._unregister(self._objects[object.name])
             self._objects[object.name] = object
+            self._register(object)
+            self._pending.add(object.name)
+            self._deleted.discard(object.name)
         except KeyError:
             raise KeyError('No {} object in the catalog.'.format(object))
 
     def __add__(self, other):
         if isinstance(other, Object):
-            self._objects[other.name] = other
+            self.add_object(other)
         elif isinstance(other, Catalog):
-            objects = {**self._objects, **other._objects}
-            return Catalog(objects, chooser=self.chooser)
+            merged = Catalog([_copy_object(obj) for obj in self._objects.values()], chooser=self.chooser)
+            merged.merge(other)
+            return merged
+
+    def diff(self, other):
+        """The changeset that turns this catalog into the catalog other, as a dictionary with
+            'added': {object name: json_ready dictionary of the object},
+            'removed': [object names],
+            'modified': {object name: changes to the object}
+        where the changes to an object are likewise a dictionary of 'added' and 'removed' properties and
+        'modified' ones. Changes to a property give the 'removed' measurements (their positions in this
+        catalog's property), the 'added' ones ([position in other's property, measurement dictionary] pairs), and
+        the custom 'attributes' that were set and 'removed_attributes'.
+
+        Objects are compared by a hash of their content that is kept until they are changed, so objects that
+        haven't changed since the last diff are skipped without looking at them again."""
+        changeset = {'added': {}, 'removed': [], 'modified': {}}
+        for name in self.object_names:
+            if name not in other:
+                changeset['removed'].append(name)
+        for name in other.object_names:
+            obj = other[name]
+            if name not in self:
+                changeset['added'][name] = _object_state(obj)
+                continue
+            ours = self[name]
+            if ours is obj or ours._content_hash() == obj._content_hash():
+                continue
+            changeset['modified'][name] = _diff_object(ours, obj)
+        return changeset
+
+    def apply(self, changeset):
+        """Make the changes of a changeset from Catalog.diff to the catalog in place. The changeset isn't altered,
+        so it can be applied to more than one catalog."""
+        for name in changeset['removed']:
+            del self[name]
+        for d in changeset['added'].values():
+            self.add_object(Object.from_dict(_copy_state(d), trusted=True))
+        for name, changes in changeset['modified'].items():
+            obj = self[name]
+            for pname in changes['removed']:
+                del obj[pname]
+            for pname, d in changes['added'].items():
+                obj[pname] = Property.from_dict(_copy_state(d), trusted=True)
+            for pname, pchanges in changes['modified'].items():
+                _apply_property_changes(obj[pname], pchanges)
+
+    def merge(self, other, on_conflict='keep_both'):
+        """Merge the objects of the catalog other into this one, in place, and return a list of the conflicts found.
+
+        Objects and properties that only other has are copied in. For properties both have, each measurement of
+        other is added unless this catalog already has the same one, where the same means an equal value, error,
+        limit, quality, and reference. Duplicates are found by hashing those, so merging takes time linear in the
+        number of measurements.
+
+        Conflicts are dictionaries with 'object', 'property', and 'kind' keys, plus 'ours' and 'theirs' for the
+        two versions. They come in three kinds:
+            'reference': both catalogs have measurements from the same reference that the other doesn't have
+                (e.g. a value that was revised). ours and theirs are lists of those measurements and 'reference'
+                gives the reference.
+            'measurement': the same measurement has different custom attributes in each.
+            'property': a custom attribute of the property (named by 'attribute') has different values.
+
+        on_conflict says how they are resolved: 'keep_both' adds their measurements from the reference alongside
+        ours but keeps our attributes, 'ours' keeps only our side, 'theirs' replaces our side with theirs, and
+        'raise' raises a ValueError (before anything has been changed)."""
+        if on_conflict not in ('keep_both', 'ours', 'theirs', 'raise'):
+            raise ValueError('on_conflict must be one of keep_both, ours, theirs, or raise.')
+        if on_conflict == 'raise':
+            conflicts = []
+            for obj in other.objects:
+                if obj.name in self:
+                    conflicts += _merge_object(self[obj.name], obj, on_conflict, apply=False)
+            if conflicts:
+                raise ValueError('{} conflicts between the catalogs, e.g. {} of {} in {}.'.format(
+                    len(conflicts), conflicts[0]['kind'], conflicts[0]['property'], conflicts[0]['object']))
+
+        conflicts = []
+        for obj in other.objects:
+            if obj.name in self:
+                conflicts += _merge_object(self[obj.name], obj, on_conflict)
+            else:
+                self.add_object(_copy_object(obj))
+        return conflicts
 
     @objects.setter
     def objects(self, value):
@@ -172,13 +1344,22 @@ class Catalog(object):
             self._objects = value
         else:
             raise ValueError('"objects" attribute can only be set with None, a list or tuple, or a dictionary and will be made into a dictionary.')
+        self._chosen = {}
+        self._index = None
+        self._value_indexes = {}
+        for obj in self._objects.values():
+            self._register(obj)
+        self._pending = set(self._objects.keys())
+        # with every object replaced, the catalog no longer corresponds to the files it was read from
+        self._synced_path = None
 
     @property
     def property_names(self):
-        propset = set()
-        for obj in self._objects.values():
-            propset = propset | set(obj.property_names)
-        return list(propset)
+        return list(self._property_index().keys())
+
+    def objects_with(self, property):
+        """Names of the objects that have the given property."""
+        return list(self._property_index().get(property, ()))
 
     @property
     def object_names(self):
@@ -188,13 +1369,15 @@ class Catalog(object):
         return self._objects[item]
 
     def view(self, name):
-        if name not in self.property_names:
+        index = self._property_index()
+        if name not in index:
             raise KeyError('No {} property for any object in the catalog.'.format(name))
         else:
             props = []
+            have = index[name]
             for oname, obj in self._objects.items():
                 rep = '{}: '.format(oname)
-                if name in obj:
+                if oname in have:
                     prop = obj[name]
                     rep += ', '.join(map(str, prop.measurements))
                 else:
@@ -208,7 +1391,8 @@ class Catalog(object):
         return len(self._objects)
 
     def __delitem__(self, key):
-        del self._objects[key]
+        self._unregister(self._objects.pop(key))
+        self._deleted.add(key)
 
     def __contains__(self, item):
         return item in self._objects
@@ -220,14 +1404,19 @@ class Catalog(object):
         else:
             prop = obj[property]
             if choose:
-                if len(prop.measurements) == 0:
-                    return None
-                msmt = self.chooser(prop.measurements)
+                msmt, caught = self._choose(obj, property)
+                for message in caught:
+                    warn(message)
                 return msmt
             else:
                 return prop.measurements
 
-    def as_tables(self):
+    def as_tables(self, index=True, workers=None, pool='process'):
+        """Tables of the chosen measurement's value, limit, errpos, errneg, quality and ref for each object
+        (rows) and property (columns). With index=False the tables aren't indexed by object, which saves some
+        time for big catalogs. See to_arrays for a quicker way to get just some of these and _choose_parallel
+        for workers and pool."""
+        from astropy.table import Table, MaskedColumn
         # values, limits, poserr, negerr, refs
         tables = {'value' : {},
                   'limit' : {},
@@ -235,47 +1424,123 @@ class Catalog(object):
                   'errneg' : {},
                   'quality' : {},
                   'ref' : {}}
-        props = self.property_names
+        property_index = self._property_index()
+        props = list(property_index.keys())
+        self._choose_parallel(props, workers, pool)
 
         # add names of properties as keys (eventually to be column names) in each table dictionary
-        if 'object' in self.property_names:
+        if 'object' in property_index:
             warn('Apparently the objects have a property called object. However, the object column in the tables will give the names of the objects, not their "object.object" property.')
+        object_names = self.object_names
         for tbl in tables.values():
-            index = MaskedColumn(self.object_names, name='object')
-            tbl['object'] = index
+            tbl['object'] = MaskedColumn(object_names, name='object')
             for prop in props:
-                tbl[prop] = []
+                tbl[prop] = [None]*len(object_names)
 
-        # construct lists that will become tables
+        # construct lists that will become tables, visiting only the objects that have each property
+        rows = {oname: i for i, oname in enumerate(object_names)}
         arbitrary_picks = []
-        for obj in self.objects:
-            # for each property, add the chosen measurement, if any, to the table
-            for prop in props:
-                if prop in obj:
-                    msmts = obj[prop].measurements
-                    if len(msmts) > 0:
-                        with warnings.catch_warnings(record=True) as w:
-                            warnings.simplefilter('always')
-                            msmt = self.chooser(msmts)
-                            if len(w) > 0:
-                                arbitrary_picks.append([obj.name, prop])
-                        tables['value'][prop].append(msmt.value)
-                        tables['limit'][prop].append(msmt.limit)
-                        tables['errpos'][prop].append(msmt.errpos)
-                        tables['errneg'][prop].append(msmt.errneg)
-                        tables['quality'][prop].append(msmt.quality)
-                        tables['ref'][prop].append(msmt.reference)
-                        continue
-                for key in tables.keys():
-                    tables[key][prop].append(None)
-        if len(arbitrary_picks) > 0:
-            msg = ('\nCould not select a "best" measurement according to the '
-                   'catalog\'s chooser for the following:')
-            for ap in arbitrary_picks:
-                msg += ('\n    {}: {}'.format(*ap))
-            warn(msg)
+        for j, prop in enumerate(props):
+            for oname in property_index[prop]:
+                # add the chosen measurement, if any, to the table
+                msmt, caught = self._choose(self._objects[oname], prop)
+                if msmt is not None:
+                    i = rows[oname]
+                    if len(caught) > 0:
+                        arbitrary_picks.append((i, j, oname, prop))
+                    tables['value'][prop][i] = msmt.value
+                    tables['limit'][prop][i] = msmt.limit
+                    tables['errpos'][prop][i] = msmt.errpos
+                    tables['errneg'][prop][i] = msmt.errneg
+                    tables['quality'][prop][i] = msmt.quality
+                    tables['ref'][prop][i] = msmt.reference
+        _warn_arbitrary(arbitrary_picks)
 
         # format columns for use in table: set Nones to masked values and infer data types
+        with instrumentation.stage('as_tables.columns'):
+            self._make_columns(tables, props)
+
+        with instrumentation.stage('as_tables.tables'):
+            for key, cols in tables.items():
+                tables[key] = Table(cols, masked=True)
+
+            if index:
+                for tbl in tables.values():
+                    tbl.add_index('object')
+
+        return tables
+
+    def to_arrays(self, properties=None, quantities=quantities, workers=None, pool='process'):
+        """Like as_tables, but as numpy masked arrays and only for the given properties (all by default) and
+        quantities (any of 'value', 'errpos', 'errneg', 'limit', 'quality' and 'ref'). Returns a dictionary with
+        a dictionary for each quantity, holding an array of the object names under 'object' and a masked array
+        for each property. Values are floats unless they are all integers (int) or some aren't numbers (object),
+        limits are single characters, and references are objects.
+
+        The arrays are made up front and filled in one pass over the objects that have each property, so this
+        is much quicker than as_tables, which builds lists and then astropy columns and tables from them."""
+        for quantity in quantities:
+            if quantity not in _quantity_attributes:
+                raise ValueError('{} is not one of the quantities {}.'.format(quantity, Catalog.quantities))
+        property_index = self._property_index()
+        if properties is None:
+            properties = list(property_index.keys())
+        self._choose_parallel(properties, workers, pool)
+        object_names = self.object_names
+        rows = {oname: i for i, oname in enumerate(object_names)}
+        n = len(object_names)
+
+        arrays = {quantity: {'object': np.array(object_names)} for quantity in quantities}
+        arbitrary_picks = []
+        for j, prop in enumerate(properties):
+            data = {quantity: np.full(n, *_quantity_fills[quantity]) for quantity in quantities}
+            masks = {quantity: np.ones(n, bool) for quantity in quantities}
+            # None until a value turns up, so a property with no values at all stays float
+            integers = None
+            for oname in property_index.get(prop, ()):
+                msmt, caught = self._choose(self._objects[oname], prop)
+                if msmt is None:
+                    continue
+                i = rows[oname]
+                if len(caught) > 0:
+                    arbitrary_picks.append((i, j, oname, prop))
+                for quantity in quantities:
+                    x = getattr(msmt, _quantity_attributes[quantity])
+                    if x is None:
+                        continue
+                    if quantity == 'value':
+                        if type(x) is not int:
+                            integers = False
+                        elif integers is None:
+                            integers = True
+                        if data['value'].dtype != object and (type(x) is bool or not isinstance(x, (int, float))):
+                            data['value'] = data['value'].astype(object)
+                    data[quantity][i] = x
+                    masks[quantity][i] = False
+            if 'value' in quantities and integers is True and data['value'].dtype != object:
+                # (the nans under the mask have no int version)
+                data['value'] = np.where(masks['value'], 0, data['value']).astype(int)
+            for quantity in quantities:
+                arrays[quantity][prop] = np.ma.MaskedArray(data[quantity], masks[quantity])
+        _warn_arbitrary(arbitrary_picks)
+        return arrays
+
+    def to_pandas(self, properties=None, quantities=quantities, index=True, workers=None, pool='process'):
+        """The arrays from to_arrays as a pandas DataFrame for each quantity, indexed by object name (or with an
+        object column if index is False). Masked entries are nan for floats and None otherwise. Needs pandas."""
+        import pandas as pd
+        frames = {}
+        for quantity, arrays in self.to_arrays(properties, quantities, workers, pool).items():
+            names = arrays.pop('object')
+            columns = {prop: _unmasked(array) for prop, array in arrays.items()}
+            if index:
+                frames[quantity] = pd.DataFrame(columns, index=pd.Index(names, name='object'))
+            else:
+                frames[quantity] = pd.DataFrame({'object': names, **columns})
+        return frames
+
+    @staticmethod
+    def _make_columns(tables, props):
         for prop in props:
             values = tables['value'][prop]
             tables['value'][prop] = make_column(prop, values)
@@ -295,16 +1560,687 @@ class Catalog(object):
             values = tables['ref'][prop]
             tables['ref'][prop] = make_column(prop, values, 'object')
 
-        for key, cols in tables.items():
-            tables[key] = Table(cols, masked=True)
 
-        for tbl in tables.values():
-            tbl.add_index('object')
+class LazyCatalog(Catalog):
+    """A catalog that reads its objects from the directory at path only when they are accessed.
+
+    Listing object names, checking membership, and len() never parse anything. Up to cache_size objects are
+    kept in memory, evicting the least recently used. Objects that have been modified (or added) are never
+    evicted, so their changes are kept until the catalog is written, and an evicted object that is still in
+    use elsewhere is handed back rather than read again. Anything that needs every object, like as_tables or
+    property_names, reads them all (while still keeping at most cache_size of them in memory).
+
+    If properties is a list of property names, only those properties are built when an object is read and objects
+    whose files don't mention any of them are left out (this means scanning the text of every file up front, but
+    not parsing it). As with Catalog.read, such a catalog isn't tied to path and can't be written back there."""
+
+    def __init__(self, path, cache_size=1024, chooser='default', properties=None):
+        super(LazyCatalog, self).__init__(None, chooser)
+        obj_paths = self._get_obj_paths(path)
+        if properties is not None:
+            obj_paths = [opath for opath in obj_paths if _file_might_have(opath, properties)]
+        paths = OrderedDict((_object_name(basename(opath)), opath) for opath in obj_paths)
+        self._objects = _LazyObjects(self, paths, cache_size, properties)
+        self._pending = set()
+        self._synced_path = None
+        if properties is None:
+            manifest = {relpath(opath, path): _file_stat(opath) + (None,) for opath in obj_paths}
+            self._mark_synced(path, manifest)
+        else:
+            self._projected_from = abspath(path)
+        # objects with journal entries are read now and kept in memory, since their files are out of date
+        self._replay_journal(path, properties)
+        self._references = ReferenceTable.load(pathjoin(path, _references_file))
+
+    def _loaded_objects(self):
+        return self._objects.loaded()
+
+    def _load_object(self, name, source, properties=None):
+        # source is where _objects.paths says the object is kept
+        obj = _read_object(source, properties)
+        if obj is None:
+            # the file mentioned a requested property name, but not as a property
+            obj = Object(name)
+        return obj
+
+    def _object_changed(self, obj, name=None):
+        if self._objects.get(obj.name) is obj:
+            self._objects.pin(obj)
+        super(LazyCatalog, self)._object_changed(obj, name)
+
+    def write(self, path, overwrite=False, layout=None, journal=False):
+        synced = self._synced_path == abspath(path)
+        super(LazyCatalog, self).write(path, overwrite, layout, journal)
+        # objects added since the catalog was opened can now be read back from their files if they get evicted,
+        # and after a write anywhere else, all objects are read from there (the directory the catalog is now
+        # synced with) rather than from the old one
+        spec = _read_layout(path)
+        for name, opath in self._objects.paths.items():
+            if opath is None or not synced:
+                self._objects.paths[name] = pathjoin(path, _object_relpath(name, spec))
+        self._objects.unpin_clean()
+
+    def _mark_synced(self, path, manifest=None):
+        # nothing has been read yet, so there is nothing to mark clean
+        self._sync_token = object()
+        self._pending = set()
+        self._deleted = set()
+        self._journaled = set()
+        self._synced_path = abspath(path)
+        self._manifest = manifest
+
+    def _reload(self, name, path):
+        # drop any copy in memory so that the object is read again when it's next accessed
+        self._forget(name)
+        self._objects.paths[name] = path
+
+    def _forget(self, name):
+        obj = self._objects.get(name)
+        if obj is not None:
+            obj._discard_catalog(self)
+        self._objects.forget(name)
+        self._objects.paths.pop(name, None)
+        self._chosen.pop(name, None)
+        self._index = None
+        self._mark_stale(name)
+
+
+class _LazyObjects(object):
+    """Dictionary-like map of object names to objects for LazyCatalog that reads objects from their files on
+    first access and keeps an LRU cache of them."""
+
+    def __init__(self, catalog, paths, cache_size, properties=None):
+        self.catalog = catalog
+        # name: file path (or whatever else the catalog's _load_object takes), or None for objects that only exist
+        # in memory
+        self.paths = paths
+        self.cache_size = cache_size
+        self.properties = properties
+        self._cache = OrderedDict()
+        self._pinned = {}
+        self._evicted = WeakValueDictionary()
+
+    def get(self, name, default=None):
+        """Return the object if it is in memory, without reading it from disk."""
+        for d in (self._pinned, self._cache, self._evicted):
+            if name in d:
+                return d[name]
+        return default
+
+    def __getitem__(self, name):
+        if name in self._pinned:
+            return self._pinned[name]
+        if name in self._cache:
+            self._cache.move_to_end(name)
+            return self._cache[name]
+
+        obj = self._evicted.pop(name, None)
+        if obj is None:
+            obj = self.catalog._load_object(name, self.paths[name], self.properties)
+            obj._mark_clean(self.catalog._sync_token)
+            obj._add_catalog(self.catalog)
+        self._cache[name] = obj
+        self._evict()
+        return obj
+
+    def _evict(self):
+        while len(self._cache) > self.cache_size:
+            name, obj = self._cache.popitem(last=False)
+            if not self.catalog._is_clean(obj):
+                self._pinned[name] = obj
+            else:
+                self._evicted[name] = obj
+                self.catalog._chosen.pop(name, None)
+
+    def pin(self, obj):
+        self._cache.pop(obj.name, None)
+        self._evicted.pop(obj.name, None)
+        self._pinned[obj.name] = obj
+
+    def forget(self, name):
+        for d in (self._pinned, self._cache, self._evicted):
+            d.pop(name, None)
+
+    def unpin_clean(self):
+        for name, obj in list(self._pinned.items()):
+            if self.catalog._is_clean(obj) and name not in self.catalog._journaled:
+                del self._pinned[name]
+                self._cache[name] = obj
+        self._evict()
+
+    def loaded(self):
+        objs = list(self._pinned.values()) + list(self._cache.values()) + list(self._evicted.values())
+        return [obj for obj in objs if obj.name in self.paths]
+
+    def __setitem__(self, name, obj):
+        self._cache.pop(name, None)
+        self._evicted.pop(name, None)
+        self._pinned[name] = obj
+        if name not in self.paths:
+            self.paths[name] = None
+
+    def pop(self, name):
+        obj = self[name]
+        for d in (self._pinned, self._cache, self._evicted):
+            d.pop(name, None)
+        del self.paths[name]
+        return obj
+
+    def __delitem__(self, name):
+        self.pop(name)
+
+    def __contains__(self, name):
+        return name in self.paths
 
-        return tables
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return list(self.paths.keys())
+
+    def values(self):
+        for name in self.keys():
+            yield self[name]
+
+    def items(self):
+        for name in self.keys():
+            yield name, self[name]
+
+
+def _column(table, name):
+    """Data and mask (True for masked or nan entries) of a table column as numpy arrays."""
+    col = np.ma.asanyarray(table[name])
+    data = np.ma.getdata(col)
+    mask = np.ma.getmaskarray(col)
+    if data.dtype.kind == 'f':
+        mask = mask | np.isnan(data)
+    return data, mask
+
+
+def _ingest_columns(table, spec, n, reference):
+    """Validate the columns for one property in Catalog.ingest_table and return a mask of the rows with
+    values plus lists of values, errors, references, limits and qualities."""
+    def get(key):
+        data, mask = _column(table, key)
+        if len(data) != n:
+            raise ValueError('Column {} has a different length than the object column.'.format(key))
+        return data, mask
+
+    values, mask = get(spec['value'])
+    keep = ~mask
+    values = values.tolist()
+
+    errors = [None]*n
+    error = spec.get('error')
+    if type(error) in (list, tuple):
+        errpos, errneg = error
+    else:
+        errpos, errneg = spec.get('errpos'), spec.get('errneg')
+    if error is not None and errpos is None:
+        e, emask = get(error)
+        e = e.astype(float)
+        pos, neg, has_error = e, -e, ~emask
+    elif errpos is not None:
+        pos, pmask = get(errpos)
+        neg, nmask = get(errneg)
+        pos, neg = pos.astype(float), neg.astype(float)
+        if np.any(keep & (pmask != nmask)):
+            raise ValueError('Asymmetric errors need both a positive and a negative value.')
+        has_error = ~pmask
+        with np.errstate(divide='ignore', invalid='ignore'):
+            bad = has_error & keep & ((neg == 0) | (pos/neg >= 0))
+        if np.any(bad):
+            raise ValueError('If providing an asymmetric error, you must give one positive and one negative '
+                             'number (row {}).'.format(np.flatnonzero(bad)[0]))
+        flip = pos < 0
+        pos, neg = np.where(flip, neg, pos), np.where(flip, pos, neg)
+    else:
+        has_error = np.zeros(n, bool)
+    if np.any(has_error):
+        for i, p, m in zip(np.flatnonzero(has_error).tolist(), pos[has_error].tolist(), neg[has_error].tolist()):
+            errors[i] = (p, m)
+
+    limits = ['=']*n
+    if 'limit' in spec:
+        data, lmask = get(spec['limit'])
+        data = np.where(lmask, '=', data.astype(str))
+        bad = keep & ~np.isin(data, ['<', '=', '>'])
+        if np.any(bad):
+            raise ValueError('Limit must be one of =, <, or > (row {}).'.format(np.flatnonzero(bad)[0]))
+        limits = data.tolist()
+
+    qualities = [None]*n
+    if 'quality' in spec:
+        data, qmask = get(spec['quality'])
+        with np.errstate(invalid='ignore'):
+            bad = keep & ~qmask & ((data < 0) | (data > 5))
+        if np.any(bad):
+            raise ValueError('Quality must be in the range [0,5] (row {}).'.format(np.flatnonzero(bad)[0]))
+        qualities = [None if m else q for q, m in zip(data.tolist(), qmask.tolist())]
+
+    refs = [reference]*n
+    if 'reference' in spec:
+        data, rmask = get(spec['reference'])
+        refs = [reference if m else r for r, m in zip(data.tolist(), rmask.tolist())]
+
+    return keep, values, errors, refs, limits, qualities
+
+
+def _read_object(path, properties=None):
+    """Read the object saved at path. If properties is given, build only those and return None if the object has
+    none of them."""
+    with instrumentation.stage('read.io'):
+        with open(path) as f:
+            s = f.read()
+    if properties is not None and not _might_have(s, properties):
+        instrumentation.count('files_skipped')
+        return None
+    root = _catalog_root(path) if _array_key in s else None
+    with instrumentation.stage('read.parse'):
+        obj = Object.from_json(s, trusted=True, properties=properties, root=root)
+    if properties is not None and len(obj._properties) == 0:
+        return None
+    if instrumentation.current is not None:
+        instrumentation.count('files_read')
+        instrumentation.count('characters_parsed', len(s))
+        instrumentation.count('measurements_built', sum(len(prop) for prop in obj.properties))
+    return obj
+
+
+def _copy_measurement(m):
+    # arrays that haven't been loaded are left that way
+    return Measurement._trusted(m.value, m._error, m.reference, m._limit, m._quality,
+                                None if m._custom is None else dict(m._custom))
+
+
+def _copy_property(prop):
+    # attributes passed to the constructor in the order prop has them, so the copy is saved the same way
+    attrs = {k: v for k, v in prop._state().items() if k not in ('name', 'measurements')}
+    return Property(prop.name, [_copy_measurement(m) for m in prop.measurements], **attrs)
+
+
+def _copy_object(obj):
+    return Object(obj.name, [_copy_property(prop) for prop in obj.properties])
+
+
+def _measurement_key(m):
+    # what makes two measurements the same for Catalog.merge
+    key = m.value, m._error, m._limit, m._quality, m.reference
+    try:
+        hash(key)
+    except TypeError:
+        key = repr(key)
+    return key
+
+
+def _same(a, b):
+    if isinstance(a, _ArrayFile) and isinstance(b, _ArrayFile) and a.relpath == b.relpath:
+        # the files are named by their content
+        return True
+    if isinstance(a, (np.ndarray, _ArrayFile)) or isinstance(b, (np.ndarray, _ArrayFile)):
+        a, b = [x.load() if isinstance(x, _ArrayFile) else x for x in (a, b)]
+        return np.array_equal(a, b)
+    return bool(a == b)
+
+
+def _same_custom(m1, m2):
+    c1, c2 = m1._custom or {}, m2._custom or {}
+    return c1.keys() == c2.keys() and all(_same(c1[key], c2[key]) for key in c1)
+
+
+def _merge_object(ours, theirs, on_conflict, apply=True):
+    """Merge the properties of Object theirs into Object ours (see Catalog.merge), unless apply is False, and
+    return the conflicts."""
+    conflicts = []
+    for tprop in theirs.properties:
+        name = tprop.name
+        if name not in ours:
+            if apply:
+                ours[name] = _copy_property(tprop)
+            continue
+        oprop = ours[name]
+        info = {'object': ours.name, 'property': name}
+
+        for key in tprop.custom_attributes:
+            value = getattr(tprop, key)
+            if key not in oprop.custom_attributes:
+                if apply:
+                    setattr(oprop, key, value)
+            elif not _same(getattr(oprop, key), value):
+                conflicts.append(dict(info, kind='property', attribute=key, ours=getattr(oprop, key),
+                                      theirs=value))
+                if apply and on_conflict == 'theirs':
+                    setattr(oprop, key, value)
+
+        existing = {}
+        for i, m in enumerate(oprop.measurements):
+            existing.setdefault(_measurement_key(m), i)
+        matched = set()
+        new, replace_at = [], {}
+        for m in tprop.measurements:
+            i = existing.get(_measurement_key(m))
+            if i is None:
+                new.append(m)
+                continue
+            matched.add(i)
+            if not _same_custom(oprop.measurements[i], m):
+                conflicts.append(dict(info, kind='measurement', ours=oprop.measurements[i], theirs=m))
+                if on_conflict == 'theirs':
+                    replace_at[i] = m
+
+        # measurements of theirs from a reference that we have other measurements from
+        unmatched = {}
+        for i, m in enumerate(oprop.measurements):
+            if i not in matched and m.reference is not None:
+                unmatched.setdefault(m.reference, []).append(i)
+        skip, drop = set(), set()
+        by_reference = {}
+        for m in new:
+            if m.reference in unmatched:
+                by_reference.setdefault(m.reference, []).append(m)
+        for ref, tms in by_reference.items():
+            conflicts.append(dict(info, kind='reference', reference=ref,
+                                  ours=[oprop.measurements[i] for i in unmatched[ref]], theirs=tms))
+            if on_conflict == 'ours':
+                skip.update(map(id, tms))
+            elif on_conflict == 'theirs':
+                drop.update(unmatched[ref])
+        new = [m for m in new if id(m) not in skip]
+
+        if not apply:
+            continue
+        if replace_at or drop:
+            msmts = [_copy_measurement(replace_at[i]) if i in replace_at else m
+                     for i, m in enumerate(oprop.measurements) if i not in drop]
+            msmts += [_copy_measurement(m) for m in new]
+            oprop.measurements = msmts
+        elif new:
+            oprop.measurements.extend(_copy_measurement(m) for m in new)
+    return conflicts
+
+
+def _property_state(prop):
+    d = prop._state()
+    d['measurements'] = [m._state() for m in prop.measurements]
+    return d
+
+
+def _object_state(obj):
+    # like json_ready, but keeping any arrays as they are
+    return {'name': obj.name, 'properties': [_property_state(prop) for prop in obj.properties]}
+
+
+def _copy_state(d):
+    # from_dict pops keys from the measurement dictionaries it is given
+    d = dict(d)
+    if 'properties' in d:
+        d['properties'] = [_copy_state(dp) for dp in d['properties']]
+    else:
+        d['measurements'] = [dict(dm) for dm in d['measurements']]
+    return d
+
+
+def _state_key(d):
+    # a hashable stand-in for the state of a measurement, without loading any arrays from their files
+    d = dict(d)
+    _stash_arrays(d, {})
+    return json.dumps(d, sort_keys=True, default=repr)
+
+
+def _diff_object(ours, theirs):
+    changes = {'added': {}, 'removed': [], 'modified': {}}
+    for name in ours.property_names:
+        if name not in theirs:
+            changes['removed'].append(name)
+    for prop in theirs.properties:
+        if prop.name not in ours:
+            changes['added'][prop.name] = _property_state(prop)
+            continue
+        oprop = ours[prop.name]
+        pchanges = {'removed': [], 'added': [], 'attributes': {}, 'removed_attributes': []}
+        okeys = [_state_key(m._state()) for m in oprop.measurements]
+        tkeys = [_state_key(m._state()) for m in prop.measurements]
+        for op, i1, i2, j1, j2 in SequenceMatcher(None, okeys, tkeys, autojunk=False).get_opcodes():
+            if op in ('replace', 'delete'):
+                pchanges['removed'] += list(range(i1, i2))
+            if op in ('replace', 'insert'):
+                pchanges['added'] += [[j, prop.measurements[j]._state()] for j in range(j1, j2)]
+        oattrs, tattrs = oprop.custom_attributes, prop.custom_attributes
+        for key in tattrs:
+            value = getattr(prop, key)
+            if key not in oattrs or not _same(getattr(oprop, key), value):
+                pchanges['attributes'][key] = value
+        pchanges['removed_attributes'] = sorted(oattrs - tattrs)
+        if any(pchanges.values()):
+            changes['modified'][prop.name] = pchanges
+    return changes
+
+
+def _apply_property_changes(prop, changes):
+    removed = set(changes['removed'])
+    msmts = [m for i, m in enumerate(prop.measurements) if i not in removed]
+    if changes['added']:
+        dprop = {'name': prop.name, 'measurements': [dict(dm) for _, dm in changes['added']]}
+        new = Property.from_dict(dprop, trusted=True).measurements
+        for (j, _), m in zip(changes['added'], new):
+            msmts.insert(j, m)
+    if removed or changes['added']:
+        prop.measurements = msmts
+    for key, value in changes['attributes'].items():
+        setattr(prop, key, value)
+    for key in changes['removed_attributes']:
+        delattr(prop, key)
+
+
+def _catalog_root(path):
+    """The catalog directory holding the object file at path, which is up a level in the sharded layout."""
+    directory = dirname(abspath(path))
+    parent, shard = dirname(directory), basename(directory)
+    if (exists(pathjoin(parent, _layout_file)) and _read_layout(parent)['layout'] == 'sharded'
+            and len(shard) == _read_layout(parent)['prefix_length'] and set(shard) <= set('0123456789abcdef')):
+        return parent
+    return directory
+
+
+class _ArrayFile(object):
+    """An array saved in a .npy file of a catalog directory that hasn't been loaded yet. Measurement swaps it for
+    a read-only memory map of the file the first time the attribute is used."""
+    __slots__ = ('root', 'relpath')
+
+    def __init__(self, root, relpath):
+        self.root = root
+        self.relpath = relpath
+
+    @property
+    def path(self):
+        return pathjoin(self.root, self.relpath)
+
+    def load(self):
+        return np.load(self.path, mmap_mode='r')
+
+    def __getstate__(self):
+        return self.root, self.relpath
+
+    def __setstate__(self, state):
+        self.root, self.relpath = state
+
+    def __repr__(self):
+        return '_ArrayFile({!r})'.format(self.path)
+
+
+def _array_relpath(array):
+    h = hashlib.sha1('{}{}'.format(array.dtype.str, array.shape).encode())
+    h.update(np.ascontiguousarray(array).data)
+    return '{}/{}.npy'.format(_arrays_dir, h.hexdigest())
+
+
+def _stash_arrays(d, arrays):
+    """Replace the arrays among the custom attributes in d (a measurement's _state) with references to .npy files
+    and put the arrays in the arrays dictionary (relative path: array or _ArrayFile) to be saved. If arrays is None
+    they become lists instead. Empty and object arrays are always made lists."""
+    for key, value in d.items():
+        if isinstance(value, _ArrayFile):
+            if arrays is None:
+                d[key] = value.load().tolist()
+            else:
+                arrays[value.relpath] = value
+                d[key] = {_array_key: value.relpath}
+        elif isinstance(value, np.ndarray):
+            if arrays is None or value.size == 0 or value.dtype.hasobject:
+                d[key] = value.tolist()
+            else:
+                relpath = _array_relpath(value)
+                arrays[relpath] = value
+                d[key] = {_array_key: relpath}
+
+
+def _open_arrays(d, root):
+    # the reverse of _stash_arrays, though the arrays aren't read until they are used
+    for key, value in d.items():
+        if type(value) is dict and len(value) == 1 and _array_key in value:
+            d[key] = _ArrayFile(root, value[_array_key])
+
+
+def _save_arrays(root, arrays):
+    """Save arrays from _stash_arrays in the catalog directory at root. Files are named by their content, so any
+    that already exist are left alone."""
+    for rel, array in arrays.items():
+        path = pathjoin(root, rel)
+        if exists(path):
+            continue
+        makedirs(dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, getpid())
+        try:
+            if isinstance(array, _ArrayFile):
+                shutil.copyfile(array.path, tmp_path)
+            else:
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, array, allow_pickle=False)
+            replace(tmp_path, path)
+        except BaseException:
+            if exists(tmp_path):
+                remove(tmp_path)
+            raise
+
+
+def _layout_spec(layout):
+    if layout == 'sharded':
+        return {'layout': 'sharded', 'prefix_length': _prefix_length}
+    return {'layout': 'flat'}
+
+
+def _read_layout(path):
+    """The layout of the catalog directory at path, as saved in its layout.json (flat if there isn't one)."""
+    try:
+        with open(pathjoin(path, _layout_file)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return _layout_spec('flat')
+
+
+def _write_layout(path, spec):
+    _atomic_write(pathjoin(path, _layout_file), json.dumps(spec, indent=4))
+
+
+def _object_filename(name):
+    escaped = ''.join('%{:02X}'.format(ord(c)) if c in _unsafe_characters else c for c in name)
+    if escaped.startswith('.'):
+        # keep files from being hidden (or being . or ..)
+        escaped = '%2E' + escaped[1:]
+    return escaped + '.object'
+
+
+def _object_name(filename):
+    return unquote(filename[:-len('.object')])
+
+
+def _object_relpath(name, spec):
+    """Path of the file for the named object relative to the catalog directory for the given layout."""
+    filename = _object_filename(name)
+    if spec['layout'] == 'sharded':
+        shard = hashlib.sha1(name.encode('utf-8')).hexdigest()[:spec['prefix_length']]
+        return pathjoin(shard, filename)
+    return filename
+
+
+def _object_file_digest(path, name, spec):
+    # sha1 of the file of the named object in the catalog directory at path, or None if it has no file
+    opath = pathjoin(path, _object_relpath(name, spec))
+    if not exists(opath):
+        # where it would be part way through migrate_layout
+        opath = pathjoin(path, _object_filename(name))
+        if not exists(opath):
+            return None
+    with open(opath, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _record_object_name(record):
+    if record['op'] == 'set_object':
+        return record['object']['name']
+    return record['object']
+
+
+def _unpickle(f):
+    # the garbage collector would otherwise run over and over while the many small objects are made
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return pickle.load(f)
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _file_stat(path):
+    st = stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+def _scan_files(path, manifest):
+    """Compare the .object files in the directory at path to a manifest (filename: (mtime_ns, size, digest)) made
+    earlier. Files with the same mtime and size are taken to be unchanged, others are hashed and compared to the
+    digest. Returns the new manifest and the set of files that are new or whose content changed."""
+    new, changed = {}, set()
+    for opath in Catalog._get_obj_paths(path):
+        filename = relpath(opath, path)
+        mtime, size = _file_stat(opath)
+        old = manifest.get(filename)
+        if old is not None and old[:2] == (mtime, size):
+            new[filename] = old
+            continue
+        with open(opath, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        new[filename] = (mtime, size, digest)
+        if old is None or old[2] != digest:
+            changed.add(filename)
+    return new, changed
+
+
+def _might_have(s, properties):
+    # cheap check of the raw text before parsing: a property name that isn't anywhere in it can't be a property
+    return any(json.dumps(name) in s for name in properties)
 
 
-class Object(object):
+def _file_might_have(path, properties):
+    with open(path) as f:
+        return _might_have(f.read(), properties)
+
+
+def _read_objects(paths, properties=None):
+    objs = (_read_object(path, properties) for path in paths)
+    return [obj for obj in objs if obj is not None]
+
+
+class Object(Tracked):
+    _untracked = Tracked._untracked | {'_catalogs', '_hash', '_clean_token'}
+    # weak references to the catalogs the object belongs to (a tuple, since it is rarely more than one)
+    _catalogs = ()
+    _clean_token = None
+
     def __init__(self, name, properties=None):
         self.name = name
         if properties is None:
@@ -312,16 +2248,28 @@ class Object(object):
         else:
             self.properties = properties
 
-    def to_json(self):
-        d = self.__dict__.copy()
+    def json_ready(self, arrays=None):
+        """See Property.json_ready for arrays."""
+        d = self._state()
         props = d.pop('_properties')
 
         # for each entry that is actually a list of objects, get the dictionary form of each
-        jprops = [prop.json_ready() for prop in props.values()]
+        jprops = [prop.json_ready(arrays) for prop in props.values()]
         d['properties'] = jprops
+        return d
 
+    def to_json(self, arrays=None):
         # now serialize the whole thing
-        return json.dumps(d, indent=4)
+        return json.dumps(self.json_ready(arrays), indent=4)
+
+    def _content_hash(self):
+        # kept until the object is changed (see _touch). Arrays are hashed by the names of their files, which come
+        # from their content
+        h = self.__dict__.get('_hash')
+        if h is None:
+            s = json.dumps(self.json_ready({}), sort_keys=True, default=repr)
+            h = self.__dict__['_hash'] = hashlib.sha1(s.encode('utf-8')).hexdigest()
+        return h
 
     @classmethod
     def from_object(cls, object):
@@ -329,11 +2277,16 @@ class Object(object):
         return Object(object.name, props)
 
     @classmethod
-    def from_json(cls, s):
-        d = json.loads(s)
+    def from_json(cls, s, trusted=False, properties=None, root=None):
+        return cls.from_dict(json.loads(s), trusted, properties, root)
 
+    @classmethod
+    def from_dict(cls, d, trusted=False, properties=None, root=None):
         dprops = d['properties']
-        props = [Property.from_dict(dp) for dp in dprops]
+        if properties is not None:
+            properties = set(properties)
+            dprops = [dp for dp in dprops if dp['name'] in properties]
+        props = [Property.from_dict(dp, trusted, root) for dp in dprops]
 
         return Object(d['name'], props)
 
@@ -354,9 +2307,45 @@ class Object(object):
 
     def add_measurement(self, property_name, value, error=None, reference=None, limit='=', quality=None, **kws):
         if property_name not in self:
-            self._properties[property_name] = Property(property_name)
+            prop = Property(property_name)
+            self._adopt(prop)
+            self._properties[property_name] = prop
         self[property_name].add_measurement(value, error, reference, limit, quality, **kws)
 
+    def _mark_clean(self, token=None):
+        # token is the Catalog._sync_token of the catalog that read or saved the object
+        for prop in self._properties.values():
+            prop._mark_clean()
+        Tracked._mark_clean(self)
+        self.__dict__['_clean_token'] = token
+
+    def _touch(self, child=None):
+        # child is the property (or name of the property) that changed, if any
+        self.__dict__.pop('_hash', None)
+        Tracked._touch(self, child)
+        name = child.name if isinstance(child, Property) else child
+        for ref in self._catalogs:
+            catalog = ref()
+            if catalog is not None:
+                catalog._object_changed(self, name)
+
+    def _add_catalog(self, catalog):
+        if all(ref() is not catalog for ref in self._catalogs):
+            self.__dict__['_catalogs'] = self._live_catalogs() + (weakref(catalog),)
+
+    def _discard_catalog(self, catalog):
+        self.__dict__['_catalogs'] = tuple(ref for ref in self._live_catalogs() if ref() is not catalog)
+
+    def _live_catalogs(self):
+        return tuple(ref for ref in self._catalogs if ref() is not None)
+
+    def __getstate__(self):
+        # catalogs are tracked with weak references, which can't be pickled
+        d = self.__dict__.copy()
+        d.pop('_catalogs', None)
+        d.pop('_clean_token', None)
+        return d
+
     @properties.setter
     def properties(self, value):
         if value is None:
@@ -370,6 +2359,8 @@ class Object(object):
             self._properties = value
         else:
             raise ValueError('"properties" attribute can only be set with None, a list or tuple, or a dictionary and will be made into a dictionary.')
+        for prop in self._properties.values():
+            self._adopt(prop)
 
     @property
     def property_names(self):
@@ -383,10 +2374,14 @@ class Object(object):
 
     def __add__(self, other):
         if isinstance(other, Property):
+            other._replaced()
+            self._adopt(other)
             self._properties[other.name] = other
+            self._touch(other.name)
         elif isinstance(other, Object):
+            # copies, since a property can only belong to one object
             props = {**self._properties, **other._properties}
-            return Object(props)
+            return Object(self.name, [_copy_property(prop) for prop in props.values()])
 
     def __contains__(self, item):
         return item in self._properties
@@ -397,44 +2392,140 @@ class Object(object):
     def __setitem__(self, key, value):
         if not isinstance(value, Property):
             raise ValueError('Can only set a property with a Property object.')
+        value._replaced()
+        self._adopt(value)
         self._properties[key] = value
+        self._touch(key)
 
     def __delitem__(self, key):
         del self._properties[key]
+        self._touch(key)
 
     def __len__(self):
         return len(self._properties)
 
 
+class _MeasurementList(list):
+    """The measurements of a Property. Changing the list directly counts as a change to the property: appending
+    or extending as added measurements, anything else (removing, inserting, reordering) as a change to the whole
+    property."""
+    __slots__ = ('_owner',)
+
+    def __init__(self, owner, msmts=()):
+        list.__init__(self, msmts)
+        self._owner = owner
+
+    def __reduce__(self):
+        return _MeasurementList, (self._owner, list(self))
+
+    def _added(self, msmts):
+        for msmt in msmts:
+            self._owner._adopt(msmt)
+            # so a journal sees it as new even if it came from elsewhere
+            object.__setattr__(msmt, '_modified', True)
+
+    def _changed(self):
+        for msmt in self:
+            self._owner._adopt(msmt)
+        Tracked._touch(self._owner)
+
+    def append(self, msmt):
+        list.append(self, msmt)
+        self._added([msmt])
+        self._owner._appended()
+
+    def extend(self, msmts):
+        msmts = list(msmts)
+        list.extend(self, msmts)
+        self._added(msmts)
+        if msmts:
+            self._owner._appended()
+
+    def __iadd__(self, msmts):
+        self.extend(msmts)
+        return self
+
+
+def _changes_whole_list(name):
+    method = getattr(list, name)
+
+    def changed(self, *args, **kws):
+        result = method(self, *args, **kws)
+        self._changed()
+        return result
+    changed.__name__ = name
+    return changed
+
+
+for _name in ('insert', 'pop', 'remove', 'clear', 'sort', 'reverse', '__setitem__', '__delitem__', '__imul__'):
+    setattr(_MeasurementList, _name, _changes_whole_list(_name))
+
+
 class Property(Extensible):
     def __init__(self, name, measurements=None, **kws):
         super(Property, self).__init__(**kws)
         self.name = name
-        if measurements is None:
-            self.measurements = []
-        else:
-            self.measurements = measurements
+        self.measurements = [] if measurements is None else measurements
+
+    @property
+    def measurements(self):
+        return self.__dict__['measurements']
+
+    @measurements.setter
+    def measurements(self, value):
+        # (the change itself is passed on by Tracked.__setattr__)
+        msmts = _MeasurementList(self, value)
+        for msmt in msmts:
+            self._adopt(msmt)
+        self.__dict__['measurements'] = msmts
 
     @classmethod
     def from_property(cls, property):
         msmts = [Measurement.from_measurement(m) for m in property.measurements]
         return Property(property.name, msmts)
 
-    def json_ready(self):
-        d = self.__dict__.copy()
+    @property
+    def custom_attributes(self):
+        return set(self._state().keys()) - {'name', 'measurements'}
+
+    def json_ready(self, arrays=None):
+        """Dictionary form of the property. Numpy arrays among the custom attributes of its measurements are
+        swapped for references to .npy files and collected in arrays (relative path: array) if it is a dictionary,
+        or made into lists if it is None."""
+        d = self._state()
 
         # for each entry that is actually a list of objects, get the dictionary representation of each
         msmts = d.pop('measurements')
-        jmsmts = [m.__dict__ for m in msmts]
+        jmsmts = [m._state() for m in msmts]
+        for m, jm in zip(msmts, jmsmts):
+            if m._custom is not None:
+                _stash_arrays(jm, arrays)
         d['measurements'] = jmsmts
 
         # now serialize the whole thing
         return d
 
     @classmethod
-    def from_dict(cls, d):
+    def from_dict(cls, d, trusted=False, root=None):
+        """Make a Property from its json_ready dictionary. Use trusted=True only for data that deepcat itself
+        wrote (or otherwise already validated), as it skips the checks on each measurement's error, limit, and
+        quality. root is the catalog directory that references to .npy files are relative to."""
         msmts = []
+        new = Measurement._trusted
+        # the same few citations and property names come up over and over, so share one copy of each
+        intern = sys.intern
+        d['name'] = intern(d['name'])
         for msmt in d['measurements']:
+            if root is not None:
+                _open_arrays(msmt, root)
+            if trusted and msmt.keys().isdisjoint(Measurement._legacy_keys):
+                # keys as written by Property.json_ready
+                ref = msmt.pop('reference', None)
+                if type(ref) is str:
+                    ref = intern(ref)
+                msmts.append(new(msmt.pop('value', None), msmt.pop('_error', None), ref,
+                                 msmt.pop('_limit', '='), msmt.pop('_quality', None), msmt))
+                continue
             for key in ['_value', '_error', '_reference', '_limit', '_quality']:
                 if key in msmt:
                     msmt[key[1:]] = msmt.pop(key)
@@ -456,21 +2547,114 @@ class Property(Extensible):
         return len(self.measurements)
 
     def add_measurement(self, value, error=None, reference=None, limit='=', quality=None, **kws):
-        msmt = Measurement(value, error, reference, limit, quality, **kws)
-        self.measurements.append(msmt)
+        self.measurements.append(Measurement(value, error, reference, limit, quality, **kws))
+
+    def _appended(self):
+        # a change that only added measurements to the end of the list. If that's all that has changed since the
+        # property was saved, it is marked as such so a journal can record just the new measurements (which are
+        # the ones at the end that are modified)
+        appended_only = self._modified is False or self._modified == 'appended'
+        Tracked._touch(self)
+        if appended_only:
+            self.__dict__['_modified'] = 'appended'
+
+    def _replaced(self):
+        # the property was put in place of another, so has to be saved whole (its new parent is told separately)
+        self.__dict__['_modified'] = True
+
+    def _mark_clean(self):
+        for msmt in self.measurements:
+            msmt._mark_clean()
+        Tracked._mark_clean(self)
 
 
 class Measurement(Extensible):
+    """There can be millions of these, so they keep the default attributes in slots and only make a dictionary
+    for custom attributes if there are any."""
+    __slots__ = ('value', '_error', 'reference', '_limit', '_quality', '_custom', '_parent', '_modified')
     default_attributes = {'value', 'error', 'reference', 'limit', 'quality'}
+    # names under which the default attributes actually live in the instance (and in the .object files)
+    stored_attributes = {'value', '_error', 'reference', '_limit', '_quality'}
+    # keys of older files that need the full treatment of from_dict
+    _legacy_keys = {'error', 'limit', 'quality', '_value', '_reference'}
+    _fixed_attributes = set(__slots__) | default_attributes
 
     def __init__(self, value, error=None, reference=None, limit='=', quality=None, **kws):
+        object.__setattr__(self, '_parent', None)
+        object.__setattr__(self, '_modified', True)
+        object.__setattr__(self, '_custom', None)
         super(Measurement, self).__init__(**kws)
         self.value = value
         self.error = error
-        self.reference = reference
+        self.reference = sys.intern(reference) if type(reference) is str else reference
         self.limit = limit
         self.quality = quality
 
+    @classmethod
+    def _trusted(cls, value, error=None, reference=None, limit='=', quality=None, custom=None):
+        """Make a measurement without any of the checks done by the setters. Only for values that have already
+        been validated, like those read from a file deepcat wrote."""
+        m = object.__new__(cls)
+        setters = _measurement_setters
+        setters[0](m, value)
+        setters[1](m, None if error is None else tuple(error))
+        setters[2](m, reference)
+        setters[3](m, limit)
+        setters[4](m, quality)
+        setters[5](m, custom if custom else None)
+        setters[6](m, None)
+        setters[7](m, True)
+        return m
+
+    def __setattr__(self, key, value):
+        if key in self._fixed_attributes:
+            object.__setattr__(self, key, value)
+        else:
+            if self._custom is None:
+                object.__setattr__(self, '_custom', {})
+            self._custom[key] = value
+        if key not in self._untracked:
+            self._touch()
+
+    def __getattr__(self, key):
+        # only called for attributes that aren't in the slots, i.e. custom attributes
+        if key.startswith('__') or key in self._fixed_attributes:
+            raise AttributeError(key)
+        custom = self._custom
+        if custom is None or key not in custom:
+            raise AttributeError("'Measurement' object has no attribute '{}'".format(key))
+        value = custom[key]
+        if type(value) is _ArrayFile:
+            # first use of an array saved in a .npy file (this doesn't count as a change)
+            value = custom[key] = value.load()
+        return value
+
+    def __delattr__(self, key):
+        if key in self._fixed_attributes:
+            object.__delattr__(self, key)
+        else:
+            try:
+                del self._custom[key]
+            except (KeyError, TypeError):
+                raise AttributeError(key)
+        self._touch()
+
+    def __getstate__(self):
+        return tuple(getattr(self, key) for key in self.__slots__)
+
+    def __setstate__(self, state):
+        for setter, value in zip(_measurement_setters, state):
+            setter(self, value)
+
+    def _state(self):
+        d = {} if self._custom is None else self._custom.copy()
+        d['value'] = self.value
+        d['_error'] = self._error
+        d['reference'] = self.reference
+        d['_limit'] = self._limit
+        d['_quality'] = self._quality
+        return d
+
     @classmethod
     def from_measurement(cls, measurement):
         m = measurement
@@ -481,7 +2665,7 @@ class Measurement(Extensible):
 
     @property
     def custom_attributes(self):
-        return set(self.__dict__.keys()) - self.default_attributes
+        return set() if self._custom is None else set(self._custom.keys())
 
     @property
     def simple_error(self):
@@ -569,4 +2753,8 @@ class Measurement(Extensible):
             rep += ' (no ref)'
         else:
             rep += ' ({})'.format(self.reference)
-        return rep
\ No newline at end of file
+        return rep
+
+
+# setters of Measurement's slots, in order, to fill them in without going through __setattr__
+_measurement_setters = [Measurement.__dict__[key].__set__ for key in Measurement.__slots__]
@@ -0,0 +1,79 @@
+"""Opt-in instrumentation of the slow parts of deepcat. Nothing is recorded unless it is turned on with
+
+    with deepcat.instrument() as stats:
+        cat = deepcat.Catalog.read('my_catalog')
+        tbls = cat.as_tables()
+    stats.as_dict()
+
+which gives the time spent and number of calls for each stage (e.g. file reading vs. json parsing in
+Catalog.read, the chooser vs. building columns and tables in as_tables) along with counters like the number of
+files read, characters parsed, and measurements built. When no instrumentation is active, the hooks are just a
+check of a module-level variable.
+
+Stats are shared by all threads, but work done in other processes (e.g. Catalog.read with pool='process') is
+not recorded."""
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# the Stats object currently collecting, if any
+current = None
+
+_null = nullcontext()
+
+
+class Stats(object):
+    def __init__(self):
+        self.times = {}
+        self.calls = {}
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            self.times[stage] = self.times.get(stage, 0.) + seconds
+            self.calls[stage] = self.calls.get(stage, 0) + 1
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def as_dict(self):
+        with self._lock:
+            stages = {name: {'seconds': self.times[name], 'calls': self.calls[name]} for name in self.times}
+            return {'stages': stages, 'counts': dict(self.counts)}
+
+    def __repr__(self):
+        return 'Stats({})'.format(self.as_dict())
+
+
+@contextmanager
+def instrument(stats=None):
+    """Collect stats (in a new Stats object unless one is given) for everything run within the context."""
+    global current
+    previous = current
+    current = Stats() if stats is None else stats
+    try:
+        yield current
+    finally:
+        current = previous
+
+
+def stage(name):
+    """Context manager that times a stage if instrumentation is on and does nothing otherwise."""
+    if current is None:
+        return _null
+    return current.stage(name)
+
+
+def count(name, n=1):
+    if current is not None:
+        current.count(name, n)
@@ -0,0 +1,110 @@
+"""The batch choosers have to pick exactly what the scalar ones would, so they are checked against each other on
+many small random lists of measurements (with few distinct values, so that ties come up often)."""
+import random
+import warnings
+
+import numpy as np
+import pytest
+
+from .. import choosers
+from ..data_structures import Catalog, Object, Measurement
+from ..columnar import limit_codes
+
+n_cases = 20000
+
+default_pipeline = [choosers.prefer_nonlimit, choosers.maximize('quality'), choosers.prefer_strictest_limit,
+                    choosers.minimize('simple_error')]
+
+
+def random_measurements(rng, strings=False):
+    # never a mix of upper and lower limits without a nonlimit, which default refuses to handle
+    flags = rng.choice(['=<', '=>', '=<>'])
+    msmts = []
+    for _ in range(rng.randint(1, 6)):
+        error = rng.choice([None, 0.1, 0.2, (0.1, -0.3)])
+        msmts.append(Measurement(rng.choice([1.0, 2.0, 3.0]), error, None, rng.choice(flags),
+                                 rng.choice([None, 1, 2])))
+    if flags == '=<>' and all(m.limit != '=' for m in msmts):
+        msmts[0].limit = '='
+    if strings:
+        # values like spectral types, which are never limits
+        for m in msmts:
+            if m.limit == '=' and rng.random() < 0.5:
+                m.value = rng.choice(['G2V', 'M5V'])
+    return msmts
+
+
+def scalar_pick(msmts):
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        chosen = choosers.default(msmts)
+    index = next(i for i, m in enumerate(msmts) if m is chosen)
+    return index, len(caught) > 0
+
+
+def number(x):
+    return np.nan if x is None else float(x)
+
+
+def test_default_batch_matches_default():
+    rng = random.Random(0)
+    groups, values, limits, qualities, errors, expected, starts = [], [], [], [], [], [], []
+    for g in range(n_cases):
+        msmts = random_measurements(rng)
+        starts.append(len(groups))
+        expected.append(scalar_pick(msmts))
+        for m in msmts:
+            groups.append(g)
+            values.append(m.value)
+            limits.append(limit_codes[m.limit])
+            qualities.append(number(m.quality))
+            errors.append(number(m.simple_error))
+    chosen, arbitrary = choosers.default_batch(groups, values, np.array(limits), qualities, errors)
+    for g, (index, warned) in enumerate(expected):
+        assert chosen[g] - starts[g] == index
+        assert arbitrary[g] == warned
+
+
+@pytest.mark.parametrize('strings', [False, True])
+def test_store_choose_matches_catalog(strings):
+    rng = random.Random(1)
+    objects = []
+    for i in range(2000):
+        obj = Object('object{}'.format(i))
+        for m in random_measurements(rng, strings):
+            obj.add_measurement('x', m.value, m.error, m.reference, m.limit, m.quality)
+        objects.append(obj)
+    catalog = Catalog(objects)
+    store = catalog.to_store()
+    rows, arbitrary = store.choose('x')
+    for obj, row, arb in zip(objects, rows, arbitrary):
+        index, warned = scalar_pick(obj['x'].measurements)
+        assert row == store.rows(property='x', object=obj.name)[index]
+        assert arb == warned
+
+
+def test_pipeline_matches_default():
+    rng = random.Random(2)
+    pipeline = choosers.Pipeline(default_pipeline)
+    for _ in range(n_cases):
+        msmts = random_measurements(rng)
+        index, warned = scalar_pick(msmts)
+        chosen, tied = pipeline.choose(msmts)
+        assert chosen is msmts[index]
+        assert (len(tied) > 0) == warned
+
+
+@pytest.mark.parametrize('strings', [False, True])
+def test_pipeline_batch_matches_default(strings):
+    rng = random.Random(3)
+    objects = []
+    for i in range(2000):
+        obj = Object('object{}'.format(i))
+        for m in random_measurements(rng, strings):
+            obj.add_measurement('x', m.value, m.error, m.reference, m.limit, m.quality)
+        objects.append(obj)
+    store = Catalog(objects).to_store()
+    expected_rows, expected_arbitrary = store.choose('x')
+    rows, arbitrary = store.choose('x', default_pipeline)
+    assert np.array_equal(rows, expected_rows)
+    assert np.array_equal(arbitrary, expected_arbitrary)
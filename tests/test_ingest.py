@@ -0,0 +1,23 @@
+"""Catalog.ingest_table and the tables made from catalogs."""
+import numpy as np
+
+from ..data_structures import Catalog
+
+
+def test_ingest_skips_empty_rows():
+    table = {'name': ['a', 'b', 'c'],
+             'x': np.ma.masked_array([1.0, 2.0, 3.0], [False, True, False]),
+             'y': [np.nan, np.nan, 1.0]}
+    cat = Catalog()
+    cat.ingest_table(table, 'name', {'x': 'x', 'y': 'y'})
+    assert cat.object_names == ['a', 'c']
+    assert list(cat['a'].property_names) == ['x']
+
+
+def test_arrays_of_empty_catalog():
+    arrays = Catalog.empty_catalog(['a', 'b'], ['x'])
+    value = arrays.to_arrays()['value']['x']
+    assert value.dtype == float and value.mask.all()
+    arrays['a'].add_measurement('x', 3)
+    value = arrays.to_arrays()['value']['x']
+    assert value.dtype == int and value[0] == 3 and value.mask[1]
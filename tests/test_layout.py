@@ -0,0 +1,86 @@
+"""Object file names and the flat and sharded layouts of a catalog directory."""
+import os
+
+import pytest
+
+from ..data_structures import (Catalog, LazyCatalog, Object, _object_filename, _object_name, _object_relpath,
+                               _layout_spec)
+
+names = ['HD 209458', 'a/b', 'back\\slash', 'RA 12:30:00', '.hidden', '..', '100%', 'already%2Fescaped', '%41',
+         'tab\there', 'what?*"<>|', 'Proxima Centauri', 'Ω Eri']
+
+
+def make_catalog(path, layout=None):
+    objects = []
+    for i, name in enumerate(names):
+        obj = Object(name)
+        obj.add_measurement('x', float(i))
+        objects.append(obj)
+    Catalog(objects).write(path, layout=layout)
+
+
+def object_files(path):
+    return sorted(os.path.relpath(os.path.join(d, f), path) for d, _, files in os.walk(path)
+                  for f in files if f.endswith('.object'))
+
+
+@pytest.mark.parametrize('name', names)
+def test_filename_round_trip(name):
+    filename = _object_filename(name)
+    assert _object_name(filename) == name
+    assert not filename.startswith('.')
+    assert os.sep not in filename and '/' not in filename and ':' not in filename
+    for layout in ['flat', 'sharded']:
+        assert _object_name(os.path.basename(_object_relpath(name, _layout_spec(layout)))) == name
+
+
+def test_filenames_distinct():
+    assert len({_object_filename(name) for name in names}) == len(names)
+    assert _object_filename('a%2Fb') != _object_filename('a/b')
+
+
+@pytest.mark.parametrize('reader', [Catalog.read, LazyCatalog])
+def test_sharded(tmp_path, reader):
+    path = tmp_path / 'cat'
+    make_catalog(path, 'sharded')
+    files = object_files(path)
+    assert len(files) == len(names) and all(os.path.dirname(f) for f in files)
+    cat = reader(path)
+    assert sorted(cat.object_names) == sorted(names)
+    for i, name in enumerate(names):
+        assert cat[name]['x'].measurements[0].value == float(i)
+
+    # writing back keeps the layout, and a layout can't be changed by writing
+    cat[names[0]].add_measurement('x', -1.0)
+    cat.write(path, overwrite=True)
+    assert object_files(path) == files
+    with pytest.raises(ValueError):
+        cat.write(path, overwrite=True, layout='flat')
+
+
+def test_migrate_layout(tmp_path):
+    path = tmp_path / 'cat'
+    make_catalog(path)
+    flat = object_files(path)
+    assert not any(os.path.dirname(f) for f in flat)
+
+    Catalog.migrate_layout(path, 'sharded')
+    sharded = object_files(path)
+    assert len(sharded) == len(names) and all(os.path.dirname(f) for f in sharded)
+    assert sorted(Catalog.read(path).object_names) == sorted(names)
+
+    Catalog.migrate_layout(path, 'flat')
+    assert object_files(path) == flat
+    assert sorted(os.listdir(path)) == sorted(flat)
+    cat = LazyCatalog(path)
+    assert [cat[name]['x'].measurements[0].value for name in names] == [float(i) for i in range(len(names))]
+
+
+def test_migrate_interrupted(tmp_path):
+    path = tmp_path / 'cat'
+    make_catalog(path)
+    Catalog.migrate_layout(path, 'sharded')
+    # as if migrating back to flat had only moved one file before stopping
+    first = object_files(path)[0]
+    os.replace(path / first, path / os.path.basename(first))
+    assert sorted(Catalog.read(path).object_names) == sorted(names)
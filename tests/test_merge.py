@@ -0,0 +1,68 @@
+"""Catalog.merge and the copies it makes."""
+import pytest
+
+from ..data_structures import Catalog, Object, Property, Measurement
+
+
+def make_catalogs():
+    ours, theirs = Object('a'), Object('a')
+    ours['x'] = Property('x', [Measurement(1.0, 0.1, 'one'), Measurement(2.0, 0.1, 'two', band='V'),
+                               Measurement(5.0, 0.1, 'four')], unit='K')
+    # a revised value from 'one', a different band for 'two', the same from 'four', and something new
+    theirs['x'] = Property('x', [Measurement(1.5, 0.1, 'one'), Measurement(2.0, 0.1, 'two', band='B'),
+                                 Measurement(5.0, 0.1, 'four'), Measurement(3.0, 0.2, 'three')], unit='C')
+    only = Object('b')
+    only['y'] = Property('y', [Measurement(4.0)], unit='m', method='fit')
+    return Catalog([ours]), Catalog([theirs, only])
+
+
+def values(cat):
+    return [(m.value, m.reference) for m in cat['a']['x'].measurements]
+
+
+def test_merge_keep_both():
+    ours, theirs = make_catalogs()
+    conflicts = ours.merge(theirs)
+    assert sorted(c['kind'] for c in conflicts) == ['measurement', 'property', 'reference']
+    # the duplicate from 'four' is left out, the revised value from 'one' is added alongside ours
+    assert values(ours) == [(1.0, 'one'), (2.0, 'two'), (5.0, 'four'), (1.5, 'one'), (3.0, 'three')]
+    assert ours['a']['x'].unit == 'K' and ours['a']['x'].measurements[1].band == 'V'
+    reference = next(c for c in conflicts if c['kind'] == 'reference')
+    assert reference['reference'] == 'one' and [m.value for m in reference['theirs']] == [1.5]
+    prop = next(c for c in conflicts if c['kind'] == 'property')
+    assert (prop['attribute'], prop['ours'], prop['theirs']) == ('unit', 'K', 'C')
+
+
+def test_merge_ours():
+    ours, theirs = make_catalogs()
+    ours.merge(theirs, on_conflict='ours')
+    assert values(ours) == [(1.0, 'one'), (2.0, 'two'), (5.0, 'four'), (3.0, 'three')]
+    assert ours['a']['x'].unit == 'K' and ours['a']['x'].measurements[1].band == 'V'
+
+
+def test_merge_theirs():
+    ours, theirs = make_catalogs()
+    ours.merge(theirs, on_conflict='theirs')
+    assert values(ours) == [(2.0, 'two'), (5.0, 'four'), (1.5, 'one'), (3.0, 'three')]
+    assert ours['a']['x'].unit == 'C' and ours['a']['x'].measurements[0].band == 'B'
+
+
+def test_merge_raise_changes_nothing():
+    ours, theirs = make_catalogs()
+    before = ours['a'].json_ready()
+    with pytest.raises(ValueError):
+        ours.merge(theirs, on_conflict='raise')
+    assert ours['a'].json_ready() == before and 'b' not in ours
+
+
+def test_merge_copies():
+    ours, theirs = make_catalogs()
+    ours.merge(theirs)
+    copied = ours['b']['y']
+    assert copied is not theirs['b']['y'] and theirs['b']['y']._parent is theirs['b']
+    # attributes keep their order, so the copy is saved the same way
+    assert list(copied.json_ready()) == list(theirs['b']['y'].json_ready())
+    added = ours['a']['x'].measurements[-1]
+    assert added is not theirs['a']['x'].measurements[-1]
+    combined = ours['a'] + theirs['b']
+    assert list(combined['x'].json_ready()) == list(ours['a']['x'].json_ready())
@@ -0,0 +1,105 @@
+"""Array-valued custom attributes have to survive the round trip through a packed file."""
+import gc
+
+import numpy as np
+import pytest
+
+from ..benchmark import synthetic_catalog
+from ..columnar import StoreCatalog
+from ..data_structures import Catalog, Object, Property, Measurement, _ArrayFile
+
+
+def test_packed_arrays(tmp_path):
+    spectrum = np.linspace(0, 1, 50).reshape(5, 10)
+    obj = Object('a')
+    obj.add_measurement('x', 1.0, spectrum=spectrum, note='text')
+    obj.add_measurement('x', 2.0, weights=np.arange(3), empty=np.zeros(0))
+    Catalog([obj]).write(tmp_path / 'cat')
+
+    cat = Catalog.read(tmp_path / 'cat')
+    msmt = cat['a']['x'].measurements[0]
+    store = cat.to_store()
+    # reading the packed columns doesn't load arrays that are still in their files
+    assert isinstance(msmt._custom['spectrum'], _ArrayFile)
+    store.save(tmp_path / 'cat.packed')
+
+    for mmap in [False, True]:
+        msmts = Catalog.read_packed(tmp_path / 'cat.packed', mmap=mmap)['a']['x'].measurements
+        assert np.array_equal(msmts[0].spectrum, spectrum)
+        assert msmts[0].note == 'text'
+        assert np.array_equal(msmts[1].weights, np.arange(3))
+        assert list(msmts[1].empty) == []
+
+    cat = Catalog.read_packed(tmp_path / 'cat.packed', mmap=True)
+    cat.write(tmp_path / 'copy')
+    assert np.array_equal(Catalog.read(tmp_path / 'copy')['a']['x'].measurements[0].spectrum, spectrum)
+
+
+def test_packed_round_trip_is_exact(tmp_path):
+    objects = []
+    for name in ['a', 'b']:
+        obj = Object(name)
+        obj['attr'] = Property('attr', [Measurement(5800, 100, 'ref', quality=2, band='V')], unit='K',
+                               method='fit', zeta=1)
+        obj.add_measurement('x', 'G2V')
+        objects.append(obj)
+    Catalog(objects).write(tmp_path / 'cat')
+    Catalog.read(tmp_path / 'cat').write_packed(tmp_path / 'cat.packed')
+    Catalog.read_packed(tmp_path / 'cat.packed').write(tmp_path / 'copy')
+    for name in ['a.object', 'b.object']:
+        assert (tmp_path / 'cat' / name).read_bytes() == (tmp_path / 'copy' / name).read_bytes()
+
+
+@pytest.mark.filterwarnings('ignore::UserWarning')
+def test_store_catalog(tmp_path):
+    cat = synthetic_catalog(200, seed=1)
+    cat.write(tmp_path / 'cat')
+    cat.write_packed(tmp_path / 'cat.packed')
+    lazy = Catalog.read_packed(tmp_path / 'cat.packed', mmap=True, lazy=True, cache_size=10)
+    assert isinstance(lazy, StoreCatalog)
+    assert lazy.object_names == cat.object_names
+    assert sorted(lazy.property_names) == sorted(cat.property_names)
+    for name in cat.property_names:
+        for quantity in ['value', 'error', 'limit', 'reference']:
+            assert lazy.choose(name, quantity=quantity) == cat.choose(name, quantity=quantity)
+    # none of that needed any objects
+    assert lazy._objects.loaded() == []
+    assert lazy.to_store() is lazy.store
+
+    first, second = cat.object_names[:2]
+    assert lazy[first].json_ready() == cat[first].json_ready()
+    lazy[first].add_measurement('property0', -1.0, 1e-9, quality=5)
+    del lazy[second]
+    lazy.add_object(Object('new'))
+    lazy['new'].add_measurement('property0', -2.0)
+    assert lazy.choose('property0')[0] == -1.0 and lazy.choose('property0')[-1] == -2.0 and len(lazy) == len(cat)
+    assert 'new' in lazy.objects_with('property0') and second not in lazy.objects_with('property0')
+    assert lazy.to_store() is not lazy.store
+    # which went through every object, but kept only the changed ones and the cache
+    gc.collect()
+    assert len(lazy._objects.loaded()) <= 12
+
+    # written out, it is the same as the catalog it was made from with the same changes
+    cat[first].add_measurement('property0', -1.0, 1e-9, quality=5)
+    del cat[second]
+    cat.add_object(Object('new'))
+    cat['new'].add_measurement('property0', -2.0)
+    cat.write(tmp_path / 'expected')
+    lazy.write(tmp_path / 'copy')
+    for opath in sorted((tmp_path / 'expected').glob('*.object')):
+        assert opath.read_bytes() == (tmp_path / 'copy' / opath.name).read_bytes()
+    assert len(list((tmp_path / 'copy').glob('*.object'))) == len(cat)
+    # and from then on it works from the files
+    lazy[cat.object_names[5]].add_measurement('property1', 0.0)
+    lazy.write(tmp_path / 'copy', overwrite=True)
+    assert len(Catalog.read(tmp_path / 'copy')[cat.object_names[5]]['property1']) == len(cat[cat.object_names[5]]['property1']) + 1
+
+
+def test_store_catalog_properties(tmp_path):
+    cat = synthetic_catalog(50, seed=2)
+    cat['object0000003'].add_measurement('rare', 1.0)
+    cat.write_packed(tmp_path / 'cat.packed')
+    lazy = Catalog.read_packed(tmp_path / 'cat.packed', lazy=True, properties=['rare'])
+    assert lazy.object_names == ['object0000003'] and lazy.property_names == ['rare']
+    assert lazy.choose('rare') == [1.0] and lazy.choose('property0') == [None]
+    assert list(lazy['object0000003'].property_names) == ['rare']
@@ -0,0 +1,226 @@
+"""Writing back to a catalog directory only rewrites the objects that changed, so every way of changing an object has
+to be noticed, whichever catalog it was changed through."""
+import pickle
+import shutil
+
+import pytest
+
+from ..data_structures import Catalog, LazyCatalog, Object, Measurement
+
+
+def make_catalog(path):
+    objects = []
+    for name in ['a', 'b']:
+        obj = Object(name)
+        for value in [1.0, 2.0, 3.0]:
+            obj.add_measurement('x', value)
+        objects.append(obj)
+    Catalog(objects).write(path)
+
+
+def values(path, name='a', reader=Catalog.read):
+    return [m.value for m in reader(path)[name]['x'].measurements]
+
+
+def test_write_elsewhere_does_not_mark_clean(tmp_path):
+    path, backup = tmp_path / 'cat', tmp_path / 'backup'
+    make_catalog(path)
+    cat = Catalog.read(path)
+    cat['a'].add_measurement('x', 4.0)
+    Catalog(cat.objects).write(backup)
+    cat.write(path, overwrite=True)
+    assert values(path) == [1.0, 2.0, 3.0, 4.0]
+    assert values(backup) == [1.0, 2.0, 3.0, 4.0]
+
+
+def test_shared_objects_synced_separately(tmp_path):
+    path, other = tmp_path / 'cat', tmp_path / 'other'
+    make_catalog(path)
+    make_catalog(other)
+    cat, cat2 = Catalog.read(path), Catalog.read(other)
+    cat2.add_object(cat['a'])
+    cat2.write(other, overwrite=True)
+    cat['a'].add_measurement('x', 4.0)
+    cat.write(path, overwrite=True)
+    cat2.write(other, overwrite=True)
+    assert values(other) == [1.0, 2.0, 3.0, 4.0]
+
+
+def test_direct_list_edits(tmp_path):
+    path = tmp_path / 'cat'
+    make_catalog(path)
+    cat = Catalog.read(path)
+    cat['a']['x'].measurements.pop()
+    cat['b']['x'].measurements.reverse()
+    assert cat.modified
+    cat.write(path, overwrite=True)
+    assert values(path) == [1.0, 2.0]
+    assert values(path, 'b') == [3.0, 2.0, 1.0]
+
+
+def test_direct_list_edits_journaled(tmp_path):
+    path = tmp_path / 'cat'
+    make_catalog(path)
+    cat = Catalog.read(path)
+    cat['a']['x'].measurements.remove(cat['a']['x'].measurements[0])
+    cat.write(path, overwrite=True, journal=True)
+    cat['b']['x'].measurements.extend(Catalog.read(path)['b']['x'].measurements[:1])
+    cat.write(path, overwrite=True, journal=True)
+    assert values(path) == [2.0, 3.0]
+    assert values(path, 'b') == [1.0, 2.0, 3.0, 1.0]
+    assert values(path, reader=LazyCatalog) == [2.0, 3.0]
+    assert values(path, 'b', reader=LazyCatalog) == [1.0, 2.0, 3.0, 1.0]
+
+
+def test_cached_choices_follow_list_edits():
+    obj = Object('a')
+    for value in [1.0, 2.0, 3.0]:
+        obj.add_measurement('x', value, error=value)
+    cat = Catalog([obj])
+    assert cat.choose('x', 'a') == 1.0
+    assert cat.query(x=1.0) == ['a']
+    msmts = obj['x'].measurements
+    msmts.pop(0)
+    assert cat.choose('x', 'a') == 2.0
+    assert cat.query(x=1.0) == [] and cat.query(x=2.0) == ['a']
+    msmts[1] = Measurement(0.5, 0.1)
+    assert cat.choose('x', 'a') == 0.5
+    del msmts[:]
+    assert cat.choose('x', 'a') is None
+    assert cat.query(x=(None, None)) == []
+
+
+def test_diff_follows_list_edits():
+    obj = Object('a')
+    for value in [1.0, 2.0, 3.0]:
+        obj.add_measurement('x', value)
+    cat, other = Catalog([obj]), Catalog([Object.from_dict(obj.json_ready())])
+    assert cat.diff(other) == {'added': {}, 'removed': [], 'modified': {}}
+    other['a']['x'].measurements.pop()
+    assert cat.diff(other)['modified']['a']['modified']['x']['removed'] == [2]
+
+
+def test_journal_drops_batch_cut_between_lines(tmp_path):
+    path = tmp_path / 'cat'
+    make_catalog(path)
+    cat = Catalog.read(path)
+    cat['a'].add_measurement('x', 4.0)
+    cat.write(path, overwrite=True, journal=True)
+    # as if a crash had left everything but the commit record of a second batch
+    journal = path / 'journal.jsonl'
+    lines = journal.read_text().splitlines(keepends=True)
+    journal.write_text(''.join(lines + lines[:-1]))
+    cat = Catalog.read(path)
+    cat['b'].add_measurement('x', 4.0)
+    cat.write(path, overwrite=True, journal=True)
+    assert values(path) == [1.0, 2.0, 3.0, 4.0]
+    assert values(path, 'b') == [1.0, 2.0, 3.0, 4.0]
+
+
+def test_journal_skips_records_already_compacted(tmp_path):
+    path = tmp_path / 'cat'
+    make_catalog(path)
+    cat = Catalog.read(path)
+    cat['a'].add_measurement('x', 4.0)
+    cat['b']['x'].measurements.pop()
+    cat.write(path, overwrite=True, journal=True)
+    # as if a crash had stopped compaction after the object files were rewritten but before the journal was removed
+    journal = path / 'journal.jsonl'
+    text, old = journal.read_text(), (path / 'a.object').read_text()
+    cat.compact()
+    journal.write_text(text)
+    assert values(path) == [1.0, 2.0, 3.0, 4.0]
+    assert values(path, 'b') == [1.0, 2.0]
+    # or after rewriting only some of them
+    (path / 'a.object').write_text(old)
+    assert values(path) == [1.0, 2.0, 3.0, 4.0]
+    assert values(path, 'b') == [1.0, 2.0]
+
+
+def test_adding_objects_copies_properties():
+    a, b = Object('a'), Object('b')
+    a.add_measurement('x', 1.0)
+    b.add_measurement('y', 2.0)
+    combined = a + b
+    combined['x'].measurements.pop()
+    combined['y'].add_measurement(3.0)
+    assert len(a['x']) == 1 and len(b['y']) == 1
+    assert a['x']._parent is a and b['y']._parent is b
+
+
+def test_projection_not_written_over_source(tmp_path):
+    path = tmp_path / 'cat'
+    make_catalog(path)
+    full = Catalog.read(path)
+    full['a'].add_measurement('y', 1.0)
+    full.write(path, overwrite=True)
+    for cat in [Catalog.read(path, properties=['x']), LazyCatalog(path, properties=['x'])]:
+        with pytest.raises(ValueError):
+            cat.write(path, overwrite=True)
+        with pytest.raises(ValueError):
+            cat.write(path, overwrite=True, journal=True)
+        cat.write(tmp_path / 'projected')
+        assert values(tmp_path / 'projected') == [1.0, 2.0, 3.0]
+        shutil.rmtree(tmp_path / 'projected')
+    assert 'y' in Catalog.read(path)['a']
+
+
+class Gone(object):
+    pass
+
+
+def test_cache_ignored_and_rebuilt(tmp_path):
+    path = tmp_path / 'cat'
+    make_catalog(path)
+    Catalog.read(path, cache=True)
+    assert (path / '.deepcat_cache' / '.gitignore').read_text() == '*\n'
+    # as if the pickle referred to a class that has since been removed
+    snapshot = path / '.deepcat_cache' / 'snapshot.pickle'
+    snapshot.write_bytes(pickle.dumps(Gone()).replace(b'Gone', b'Lost'))
+    assert values(path, reader=lambda p: Catalog.read(p, cache=True)) == [1.0, 2.0, 3.0]
+
+
+def test_references_kept_up_to_date(tmp_path):
+    path = tmp_path / 'cat'
+    make_catalog(path)
+    cat = Catalog.read(path)
+    cat['a'].add_measurement('x', 4.0, reference='one')
+    assert list(cat.references) == ['one']
+    cat['b']['x'].measurements[0].reference = 'two'
+    assert list(cat.references) == ['one', 'two']
+    cat.write(path, overwrite=True)
+
+    lazy = LazyCatalog(path)
+    lazy['b'].add_measurement('x', 5.0, reference='three')
+    assert list(lazy.references) == ['one', 'two', 'three']
+    # only the object that was used has been read
+    assert [obj.name for obj in lazy._objects.loaded()] == ['b']
+    lazy.write(path, overwrite=True)
+    assert list(Catalog.read(path).references) == ['one', 'two', 'three']
+
+
+def test_lazy_modified_reads_nothing(tmp_path):
+    path = tmp_path / 'cat'
+    make_catalog(path)
+    lazy = LazyCatalog(path)
+    assert not lazy.modified
+    assert list(lazy._objects.loaded()) == []
+    lazy['a']['x'].measurements.pop()
+    assert lazy.modified
+
+
+def test_lazy_reads_from_where_it_was_written(tmp_path):
+    path, other = tmp_path / 'cat', tmp_path / 'other'
+    make_catalog(path)
+    lazy = LazyCatalog(path, cache_size=1)
+    lazy.write(other)
+    cat = Catalog.read(path)
+    cat['a'].add_measurement('x', 4.0)
+    cat.write(path, overwrite=True)
+    assert [m.value for m in lazy['a']['x'].measurements] == [1.0, 2.0, 3.0]
+    shutil.rmtree(path)
+    assert [m.value for m in lazy['b']['x'].measurements] == [1.0, 2.0, 3.0]
+    lazy['a'].add_measurement('x', 5.0)
+    lazy['b']
+    lazy.write(other, overwrite=True)
+    assert values(other) == [1.0, 2.0, 3.0, 5.0]